@@ -1,20 +1,155 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort, Response, stream_with_context, make_response
+from flask import Blueprint, current_app, g, has_request_context, request_started, request_finished, before_render_template, template_rendered
+import click
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.utils import secure_filename
+from flask_sqlalchemy.session import Session
+from werkzeug.local import LocalProxy
+from werkzeug.utils import secure_filename, safe_join
 from werkzeug.security import check_password_hash, generate_password_hash
 import os
-from functools import wraps
+import re
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import multiprocessing
+import time
+import threading
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import partial, wraps
+from itertools import groupby
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload, selectinload
 
-app = Flask(__name__)
+tienda = Blueprint("tienda", __name__, cli_group=None)
 
-# Clave para usar session
-app.secret_key = "clave_secreta_para_la_app"
+# Pool de conexiones, según el motor de cada base
+def opciones_pool(uri):
+    opciones = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+    url = make_url(uri)
+    # SQLite en memoria (sqlite://, sqlite:///:memory:) usa una sola conexión
+    # (StaticPool), que no acepta tamaño de pool
+    en_memoria = url.get_backend_name() == 'sqlite' and (
+        url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory')
+    if not en_memoria:
+        opciones.update({
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        })
+    return opciones
+
+def configurar(app):
+    """Configuración por defecto, tomada de variables de entorno (create_app puede pisarla)."""
+    # Clave para usar session
+    app.secret_key = os.environ.get('SECRET_KEY', "clave_secreta_para_la_app")
+
+    # Configuración base de datos (DATABASE_URL permite apuntar a otra base, por ejemplo un SQLite local)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'mysql+pymysql://root:@localhost/tienda_itr')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Réplica de solo lectura (opcional): las rutas marcadas con @solo_lectura leen de ahí.
+    # Las opciones de cada bind van aparte: SQLALCHEMY_ENGINE_OPTIONS solo aplica al primario
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': os.environ['DATABASE_REPLICA_URL'],
+                                                      **opciones_pool(os.environ['DATABASE_REPLICA_URL'])}}
+    # Segundos que un usuario sigue leyendo del primario después de escribir,
+    # para que no vea datos viejos mientras la réplica se pone al día
+    app.config['REPLICA_RETRASO'] = float(os.environ.get('REPLICA_RETRASO', 5))
+
+    # Configuración de la caché (CACHE_REDIS_URL es opcional: si no está, se usa la caché local)
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    app.config['CACHE_MAX_ENTRADAS'] = int(os.environ.get('CACHE_MAX_ENTRADAS', 10000))
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+    # Segundos que cada worker reusa los contadores de versión leídos de la base
+    # (0 = se leen en cada request; las ediciones del propio worker se ven al instante)
+    app.config['CACHE_VERSIONES_TTL'] = float(os.environ.get('CACHE_VERSIONES_TTL', 1))
+
+    # Imágenes de productos: carpeta de destino y cantidad de hilos que generan los tamaños
+    app.config['IMAGENES_CARPETA'] = os.path.join(app.root_path, 'static', 'img')
+    app.config['IMAGENES_WORKERS'] = int(os.environ.get('IMAGENES_WORKERS', 2))
+
+    # Plantillas: carpeta del bytecode compilado de Jinja y caché de fragmentos (FRAGMENTOS=0 la desactiva).
+    # Sin JINJA_CACHE_CARPETA, Jinja usa una carpeta temporal propia del usuario (permisos 0700)
+    app.config['JINJA_CACHE_CARPETA'] = os.environ.get('JINJA_CACHE_CARPETA')
+    app.config['FRAGMENTOS'] = os.environ.get('FRAGMENTOS', '1') == '1'
+
+    # Métricas por request (METRICAS=0 las desactiva por completo)
+    app.config['METRICAS'] = os.environ.get('METRICAS', '1') == '1'
+    # /metrics pide este token como Bearer; sin token, solo lo ve un admin logueado
+    app.config['METRICAS_TOKEN'] = os.environ.get('METRICAS_TOKEN')
+    app.config['SQL_LENTA_MS'] = float(os.environ.get('SQL_LENTA_MS', 200))
+    app.config['N_MAS_UNO_UMBRAL'] = int(os.environ.get('N_MAS_UNO_UMBRAL', 10))
+
+    # Cola de trabajos: "cola" (los procesa `flask trabajos`) o "sincrono" (al final del request, para pruebas)
+    app.config['TRABAJOS_MODO'] = os.environ.get('TRABAJOS_MODO', 'cola')
+    app.config['TRABAJOS_REINTENTOS'] = int(os.environ.get('TRABAJOS_REINTENTOS', 5))
+    app.config['TRABAJOS_ESPERA_BASE'] = float(os.environ.get('TRABAJOS_ESPERA_BASE', 10))
+    app.config['TRABAJOS_TIMEOUT'] = int(os.environ.get('TRABAJOS_TIMEOUT', 600))
+    # Días que se guardan los trabajos hechos y ventana (segundos) de la latencia en /metrics
+    app.config['TRABAJOS_RETENCION_DIAS'] = int(os.environ.get('TRABAJOS_RETENCION_DIAS', 7))
+    app.config['TRABAJOS_VENTANA_LATENCIA'] = int(os.environ.get('TRABAJOS_VENTANA_LATENCIA', 3600))
+    app.config['STOCK_MINIMO'] = int(os.environ.get('STOCK_MINIMO', 5))
+
+    # Contraseñas: método de hash (los hashes viejos se actualizan al iniciar sesión),
+    # procesos que calculan los hashes (0 = en el mismo request) y cuántos pueden esperar a la vez
+    app.config['HASH_METODO'] = os.environ.get('HASH_METODO', 'scrypt')
+    app.config['HASH_PROCESOS'] = int(os.environ.get('HASH_PROCESOS', os.cpu_count() or 2))
+    app.config['HASH_COLA_MAXIMA'] = int(os.environ.get('HASH_COLA_MAXIMA', 32))
+    # Cuánto dura cacheado el rol de un usuario (editarlo o eliminarlo lo invalida antes)
+    app.config['ROLES_TTL'] = int(os.environ.get('ROLES_TTL', 30))
+
+    # Carrito del lado del servidor: "db" (tabla carrito_items) o "memoria" (para pruebas)
+    app.config['CARRITO_BACKEND'] = os.environ.get('CARRITO_BACKEND', 'db')
+    app.config['CARRITO_TTL'] = int(os.environ.get('CARRITO_TTL', 7 * 24 * 3600))
+
+class SesionConReplica(Session):
+    """Manda las lecturas de las rutas de solo lectura a la réplica.
 
-# Configuración base de datos
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root:@localhost/tienda_itr'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    Las escrituras (flush, INSERT, UPDATE, DELETE) siempre van al primario.
+    """
 
-db = SQLAlchemy(app)
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and has_request_context() and g.get("usar_replica")
+                and not self._flushing and not isinstance(clause, UpdateBase)):
+            return db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": SesionConReplica})
+
+def de_la_app(nombre):
+    # Caché, carritos, métricas y pools son de cada aplicación: create_app los
+    # arma y acá se accede al de la aplicación actual
+    return LocalProxy(lambda: current_app.extensions["tienda"][nombre])
+
+@contextmanager
+def desde_primario():
+    # Lo que se va a guardar en la caché se lee del primario: la versión con
+    # la que se guarda ya se leyó de ahí, y una réplica atrasada dejaría
+    # datos viejos cacheados bajo la versión nueva
+    replica = has_request_context() and g.pop("usar_replica", False)
+    try:
+        yield
+    finally:
+        if replica:
+            g.usar_replica = True
 
 # ============================
 # DECORADORES DE LOGIN Y ADMIN
@@ -24,16 +159,40 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "usuario_id" not in session:
-            return redirect(url_for("login"))
+            return redirect(url_for("tienda.login"))
         return f(*args, **kwargs)
     return decorated_function
 
+def solo_lectura(f):
+    # La ruta solo lee: si hay réplica se usa, salvo que el usuario acabe de escribir
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if "replica" in current_app.config.get('SQLALCHEMY_BINDS', {}) and session.get("primario_hasta", 0) < time.time():
+            g.usar_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+@tienda.after_app_request
+def recordar_escritura(respuesta):
+    if request.method == "POST" and respuesta.status_code < 400 and "replica" in current_app.config.get('SQLALCHEMY_BINDS', {}):
+        session["primario_hasta"] = time.time() + current_app.config['REPLICA_RETRASO']
+    return respuesta
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "usuario_id" not in session:
-            return redirect(url_for("login"))
-        if session.get("usuario_rol") != "admin":
+            return redirect(url_for("tienda.login"))
+        # El rol se toma de la base (cacheado), no del que se copió a la sesión
+        # al iniciar sesión: así un admin degradado pierde el acceso enseguida
+        rol = rol_de_usuario(session["usuario_id"])
+        if rol is None:
+            session.clear()
+            return redirect(url_for("tienda.login"))
+        if session.get("usuario_rol") != rol:
+            # Solo si cambió: asignarla siempre reenviaría la cookie en cada request
+            session["usuario_rol"] = rol
+        if rol != "admin":
             return render_template("acceso_restringido.html"), 403
         return f(*args, **kwargs)
     return decorated_function
@@ -59,6 +218,30 @@ class Producto(db.Model):
     imagen = db.Column(db.String(255))
     categoria_id = db.Column(db.Integer, db.ForeignKey('categorias.id'))
 
+    # Índices para el catálogo: filtros por categoría/precio con orden estable
+    # por id (paginación por cursor) y búsqueda de texto (FULLTEXT en MySQL).
+    __table_args__ = (
+        db.Index('ix_productos_categoria_precio_id', 'categoria_id', 'precio', 'id'),
+        db.Index('ix_productos_precio_id', 'precio', 'id'),
+        db.Index('ix_productos_busqueda', 'nombre', 'descripcion', mysql_prefix='FULLTEXT'),
+    )
+
+# En SQLite el equivalente del índice FULLTEXT es una tabla FTS5 sobre nombre y
+# descripción, que los triggers mantienen al día (solo si cambian esas columnas)
+for sentencia in (
+    "CREATE VIRTUAL TABLE productos_busqueda USING fts5(nombre, descripcion, content='productos', content_rowid='id')",
+    "CREATE TRIGGER productos_busqueda_ai AFTER INSERT ON productos BEGIN "
+    "INSERT INTO productos_busqueda(rowid, nombre, descripcion) VALUES (new.id, new.nombre, new.descripcion); END",
+    "CREATE TRIGGER productos_busqueda_ad AFTER DELETE ON productos BEGIN "
+    "INSERT INTO productos_busqueda(productos_busqueda, rowid, nombre, descripcion) "
+    "VALUES ('delete', old.id, old.nombre, old.descripcion); END",
+    "CREATE TRIGGER productos_busqueda_au AFTER UPDATE OF nombre, descripcion ON productos BEGIN "
+    "INSERT INTO productos_busqueda(productos_busqueda, rowid, nombre, descripcion) "
+    "VALUES ('delete', old.id, old.nombre, old.descripcion); "
+    "INSERT INTO productos_busqueda(rowid, nombre, descripcion) VALUES (new.id, new.nombre, new.descripcion); END",
+):
+    event.listen(Producto.__table__, "after_create", db.DDL(sentencia).execute_if(dialect="sqlite"))
+
 class Usuario(db.Model):
     __tablename__ = 'usuarios'
     id = db.Column(db.Integer, primary_key=True)
@@ -89,69 +272,1319 @@ class DetallePedido(db.Model):
 
     producto = db.relationship("Producto")
 
+class ResumenVenta(db.Model):
+    # Totales de ventas ya agregados por día o mes, en total, por producto y
+    # por categoría. Se actualizan con cada pedido para que los reportes no
+    # tengan que recorrer pedidos y detalle_pedido.
+    __tablename__ = 'resumen_ventas'
+    tipo = db.Column(db.Enum('dia', 'mes'), primary_key=True)
+    dimension = db.Column(db.Enum('total', 'producto', 'categoria'), primary_key=True)
+    clave_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    periodo = db.Column(db.Date, primary_key=True)
+    pedidos = db.Column(db.Integer, nullable=False, default=0)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+    ingresos = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+
+class Trabajo(db.Model):
+    # Cola de trabajos en segundo plano. Se encolan en la misma transacción
+    # que la escritura que los origina, así no quedan trabajos huérfanos.
+    __tablename__ = 'trabajos'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    datos = db.Column(db.Text, nullable=False)
+    clave = db.Column(db.String(191), unique=True)
+    estado = db.Column(db.Enum('pendiente', 'en_curso', 'hecho', 'fallido'), nullable=False, default='pendiente')
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False)
+    disponible_en = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    creado = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    empezado = db.Column(db.DateTime)
+    terminado = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_trabajos_estado_disponible', 'estado', 'disponible_en'),
+        db.Index('ix_trabajos_estado_terminado', 'estado', 'terminado'),
+    )
+
+class CarritoItem(db.Model):
+    __tablename__ = 'carrito_items'
+    carrito_id = db.Column(db.String(32), primary_key=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('productos.id', ondelete='CASCADE'), primary_key=True)
+    cantidad = db.Column(db.Integer, nullable=False)
+    actualizado = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+
+class VersionCache(db.Model):
+    # Contadores de versión de la caché local, compartidos por todos los procesos
+    __tablename__ = 'versiones_cache'
+    clave = db.Column(db.String(191), primary_key=True)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)
+
+def insertar_o_sumar(modelo, filas, columnas):
+    """INSERT de varias filas que, si la clave primaria ya existe, suma las
+    columnas indicadas a los valores que ya tenía (un upsert por motor)."""
+    dialecto = db.engine.dialect.name
+    if dialecto == 'mysql':
+        sentencia = mysql.insert(modelo).values(filas)
+        return sentencia.on_duplicate_key_update(
+            {c: getattr(modelo, c) + sentencia.inserted[c] for c in columnas})
+    sentencia = (postgresql if dialecto == 'postgresql' else sqlite).insert(modelo).values(filas)
+    return sentencia.on_conflict_do_update(
+        index_elements=list(modelo.__table__.primary_key.columns),
+        set_={c: getattr(modelo, c) + sentencia.excluded[c] for c in columnas})
+
+# ============================
+# CACHÉ
+# ============================
+
+def versiones_del_request(claves, leer):
+    # Cada versión se lee una sola vez por request: el ETag y los datos de la
+    # página usan el mismo valor y no se repite la consulta
+    memo = g.setdefault("versiones", {}) if has_request_context() else {}
+    faltan = [clave for clave in dict.fromkeys(claves) if clave not in memo]
+    if faltan:
+        memo.update(zip(faltan, leer(faltan)))
+    return [memo[clave] for clave in claves]
+
+def recordar_versiones(valores):
+    if has_request_context() and "versiones" in g:
+        g.versiones.update(valores)
+
+
+class CacheLocal:
+    """Caché en memoria del proceso, con vencimiento (TTL) y desalojo LRU."""
+
+    def __init__(self, max_entradas=10000, ttl=300, ttl_versiones=1):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ttl_versiones = ttl_versiones
+        self.datos = OrderedDict()
+        self.versiones = {}
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave):
+        with self.lock:
+            entrada = self.datos.get(clave)
+            if entrada is None or entrada[1] < time.monotonic():
+                if entrada is not None:
+                    del self.datos[clave]
+                self.fallos += 1
+                return None
+            self.datos.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def get_many(self, claves):
+        return {clave: self.get(clave) for clave in claves}
+
+    def set(self, clave, valor, ttl=None):
+        with self.lock:
+            self.datos[clave] = (valor, time.monotonic() + (ttl or self.ttl))
+            self.datos.move_to_end(clave)
+            while len(self.datos) > self.max_entradas:
+                self.datos.popitem(last=False)
+
+    def delete(self, *claves):
+        with self.lock:
+            for clave in claves:
+                self.datos.pop(clave, None)
+
+    # Los contadores de versión van en la base: así todos los workers ven la
+    # misma versión (ETags iguales en cualquier proceso) y una edición hecha
+    # en uno deja sin efecto las copias cacheadas en los demás
+    def version(self, clave):
+        return self.versiones_de([clave])[0]
+
+    def versiones_de(self, claves):
+        return versiones_del_request(claves, self.leer_versiones) if claves else []
+
+    def leer_versiones(self, claves):
+        # Una copia local de vida corta evita ir a la base en cada request
+        ahora = time.monotonic()
+        with self.lock:
+            copias = {clave: self.versiones.get(clave) for clave in claves}
+        valores = {clave: c[0] for clave, c in copias.items() if c and c[1] > ahora}
+        faltan = [clave for clave in claves if clave not in valores]
+        if faltan:
+            # Del primario: con una réplica atrasada se seguiría usando la versión vieja
+            leidos = dict(db.session.execute(
+                db.select(VersionCache.clave, VersionCache.valor).where(VersionCache.clave.in_(faltan)),
+                bind_arguments={"bind": db.engine}).all())
+            leidos = {clave: leidos.get(clave, 0) for clave in faltan}
+            self.guardar_versiones(leidos)
+            valores.update(leidos)
+        return [valores[clave] for clave in claves]
+
+    def guardar_versiones(self, valores):
+        if self.ttl_versiones > 0:
+            vence = time.monotonic() + self.ttl_versiones
+            with self.lock:
+                if len(self.versiones) > self.max_entradas:
+                    self.versiones = {c: v for c, v in self.versiones.items() if v[1] > time.monotonic()}
+                for clave, valor in valores.items():
+                    self.versiones[clave] = (valor, vence)
+        recordar_versiones(valores)
+
+    def incr(self, clave):
+        return self.incr_many([clave])[0]
+
+    def incr_many(self, claves):
+        # Un solo upsert y un solo SELECT para todas las claves, en su propia
+        # transacción: no depende de que la sesión haga commit
+        claves = list(dict.fromkeys(claves))
+        if not claves:
+            return []
+        with db.engine.begin() as conexion:
+            conexion.execute(insertar_o_sumar(
+                VersionCache, [{"clave": clave, "valor": 1} for clave in sorted(claves)], ["valor"]))
+            valores = dict(conexion.execute(
+                db.select(VersionCache.clave, VersionCache.valor).where(VersionCache.clave.in_(claves))).all())
+        self.guardar_versiones(valores)
+        return [valores[clave] for clave in claves]
+
+    def estadisticas(self):
+        return {"backend": "local", "aciertos": self.aciertos, "fallos": self.fallos,
+                "entradas": len(self.datos), "max_entradas": self.max_entradas}
+
+
+class CacheRedis:
+    """Caché compartida entre procesos sobre Redis (sirve un redis-server local)."""
+
+    def __init__(self, url, ttl=300):
+        import redis
+        self.cliente = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave):
+        return self.get_many([clave])[clave]
+
+    def get_many(self, claves):
+        resultado = {}
+        for clave, valor in zip(claves, self.cliente.mget(claves) if claves else []):
+            if valor is None:
+                self.fallos += 1
+                resultado[clave] = None
+            else:
+                self.aciertos += 1
+                resultado[clave] = json.loads(valor)
+        return resultado
+
+    def set(self, clave, valor, ttl=None):
+        self.cliente.set(clave, json.dumps(valor), ex=ttl or self.ttl)
+
+    def delete(self, *claves):
+        if claves:
+            self.cliente.delete(*claves)
+
+    def version(self, clave):
+        return self.versiones_de([clave])[0]
+
+    def versiones_de(self, claves):
+        if not claves:
+            return []
+        return versiones_del_request(claves, lambda faltan: [int(v or 0) for v in self.cliente.mget(faltan)])
+
+    def incr(self, clave):
+        return self.incr_many([clave])[0]
+
+    def incr_many(self, claves):
+        claves = list(dict.fromkeys(claves))
+        if not claves:
+            return []
+        pipe = self.cliente.pipeline(transaction=False)
+        for clave in claves:
+            pipe.incr(clave)
+        valores = pipe.execute()
+        recordar_versiones(dict(zip(claves, valores)))
+        return valores
+
+    def estadisticas(self):
+        return {"backend": "redis", "aciertos": self.aciertos, "fallos": self.fallos,
+                "entradas": self.cliente.dbsize()}
+
+
+def crear_cache(config):
+    if config['CACHE_REDIS_URL']:
+        return CacheRedis(config['CACHE_REDIS_URL'], ttl=config['CACHE_TTL'])
+    return CacheLocal(max_entradas=config['CACHE_MAX_ENTRADAS'], ttl=config['CACHE_TTL'],
+                      ttl_versiones=config['CACHE_VERSIONES_TTL'])
+
+cache = de_la_app("cache")
+
+# En la caché guardamos diccionarios simples (no objetos del ORM) para que
+# puedan compartirse entre requests y serializarse en Redis.
+def producto_a_dict(p):
+    return {
+        "id": p.id,
+        "nombre": p.nombre,
+        "descripcion": p.descripcion,
+        "precio": float(p.precio),
+        "stock": p.stock,
+        "imagen": p.imagen,
+        "categoria_id": p.categoria_id,
+    }
+
+# Las filas cacheadas llevan la versión del producto en la clave: cuando
+# otro worker lo edita, la versión (compartida en la base) cambia y acá se
+# deja de leer la copia vieja, que vence sola por TTL.
+def claves_productos(ids):
+    versiones = cache.versiones_de([f"producto:{i}:version" for i in ids])
+    return {i: f"producto:{i}:{v}" for i, v in zip(ids, versiones)}
+
+def guardar_productos(productos):
+    claves = claves_productos([p.id for p in productos])
+    for p in productos:
+        cache.set(claves[p.id], producto_a_dict(p))
+
+def obtener_productos(ids):
+    # Busca cada producto en la caché y trae los que faltan en una sola consulta
+    claves = claves_productos(ids)
+    encontrados = cache.get_many(list(claves.values()))
+    faltan = [i for i in ids if encontrados[claves[i]] is None]
+    if faltan:
+        with desde_primario():
+            filas = Producto.query.filter(Producto.id.in_(faltan)).all()
+        for p in filas:
+            encontrados[claves[p.id]] = producto_a_dict(p)
+            cache.set(claves[p.id], encontrados[claves[p.id]])
+    return [encontrados[claves[i]] for i in ids if encontrados[claves[i]]]
+
+def obtener_producto_o_404(id):
+    productos = obtener_productos([id])
+    if not productos:
+        abort(404)
+    return productos[0]
+
+def obtener_categorias():
+    clave = f"categorias:{cache.version('catalogo:version')}"
+    categorias = cache.get(clave)
+    if categorias is None:
+        with desde_primario():
+            categorias = [{"id": c.id, "nombre": c.nombre} for c in Categoria.query.all()]
+        cache.set(clave, categorias)
+    return categorias
+
+def invalidar_productos(*ids, listados=True):
+    # Sube la versión de esos productos, con lo que sus filas cacheadas dejan
+    # de usarse en todos los workers. Si cambió algo que afecta a los filtros
+    # (nombre, precio, categoría, altas y bajas), además sube la versión del
+    # catálogo para descartar los listados guardados.
+    claves = [f"producto:{i}:version" for i in ids]
+    if listados:
+        claves.append("catalogo:version")
+    cache.incr_many(claves)
+
+def invalidar_categorias():
+    cache.incr("catalogo:version")
+
+def clave_catalogo(busqueda, orden, categorias, precio_max, cursor):
+    # Normalizamos los argumentos para que el mismo filtro siempre use la misma clave
+    filtro = {
+        "q": busqueda.lower(),
+        "orden": orden,
+        "categorias": sorted(set(categorias)),
+        "precio": str(precio_max),
+        "despues": cursor,
+    }
+    version = cache.version("catalogo:version")
+    return f"catalogo:{version}:" + json.dumps(filtro, sort_keys=True)
+
+@tienda.route('/admin/cache')
+@admin_required
+def admin_cache():
+    return jsonify(cache.estadisticas())
+
+# ============================
+# IMÁGENES
+# ============================
+
+# Pillow es opcional: sin él se guardan los originales y se sirven tal cual
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Ancho máximo de cada tamaño que se genera a partir del original
+MEDIDAS_IMAGEN = {"miniatura": 120, "card": 400, "detalle": 900}
+
+procesador_imagenes = de_la_app("procesador_imagenes")
+variantes_listas = de_la_app("variantes_listas")
+
+def nombre_variante(nombre, medida):
+    return f"{os.path.splitext(nombre)[0]}-{medida}.webp"
+
+def generar_variantes(nombre, carpeta):
+    # Corre también en los hilos de procesador_imagenes, fuera del contexto de la app
+    if Image is None:
+        return True
+    try:
+        with Image.open(os.path.join(carpeta, nombre)) as original:
+            original.load()
+            for medida, ancho in MEDIDAS_IMAGEN.items():
+                destino = os.path.join(carpeta, nombre_variante(nombre, medida))
+                if os.path.exists(destino):
+                    continue
+                copia = original.copy()
+                copia.thumbnail((ancho, ancho * 4))
+                # Se escribe en un temporal y se renombra para no servir archivos a medias
+                copia.save(destino + ".tmp", "WEBP", quality=80)
+                os.replace(destino + ".tmp", destino)
+        return True
+    except OSError:
+        # Si no se puede procesar, se sigue sirviendo el original
+        return False
+
+def guardar_imagen(archivo):
+    """Guarda una imagen subida y devuelve su nombre de archivo.
+
+    El archivo se copia a disco de a bloques mientras se calcula su hash, y se
+    nombra con ese hash: si ya existe la misma imagen no se guarda dos veces,
+    y al no cambiar nunca su contenido puede cachearse para siempre.
+    """
+    carpeta = current_app.config['IMAGENES_CARPETA']
+    extension = os.path.splitext(secure_filename(archivo.filename))[1].lower() or ".jpg"
+    temporal = os.path.join(carpeta, f".subida-{uuid.uuid4().hex}")
+    hash_archivo = hashlib.sha256()
+    with open(temporal, "wb") as destino:
+        while True:
+            bloque = archivo.stream.read(64 * 1024)
+            if not bloque:
+                break
+            hash_archivo.update(bloque)
+            destino.write(bloque)
+    nombre = hash_archivo.hexdigest()[:20] + extension
+    if os.path.exists(os.path.join(carpeta, nombre)):
+        os.remove(temporal)
+    else:
+        os.replace(temporal, os.path.join(carpeta, nombre))
+    # Los tamaños se generan en segundo plano, con el commit del producto
+    encolar("generar_imagenes", {"imagen": nombre})
+    return nombre
+
+@tienda.app_template_global()
+def imagen_url(nombre, medida="detalle"):
+    # Usa el tamaño pedido si ya fue generado; si no, el original
+    if not nombre:
+        return url_for('static', filename='img/no-image.png')
+    variante = nombre_variante(nombre, medida)
+    if variante not in variantes_listas:
+        if not os.path.exists(os.path.join(current_app.config['IMAGENES_CARPETA'], variante)):
+            return url_for('static', filename='img/' + nombre)
+        variantes_listas.add(variante)
+    return url_for('static', filename='img/' + variante)
+
+@tienda.cli.command("generar-imagenes")
+def generar_imagenes():
+    """Genera los tamaños que falten para las imágenes de todos los productos."""
+    nombres = {nombre for (nombre,) in db.session.query(Producto.imagen).distinct() if nombre}
+    carpeta = current_app.config['IMAGENES_CARPETA']
+    nombres = [n for n in nombres if os.path.exists(os.path.join(carpeta, n))]
+    for nombre, generada in zip(nombres, procesador_imagenes.map(partial(generar_variantes, carpeta=carpeta), nombres)):
+        if not generada:
+            current_app.logger.warning("No se pudieron generar los tamaños de %s", nombre)
+    print(f"Imágenes procesadas: {len(nombres)}")
+
+# ============================
+# CACHÉ HTTP
+# ============================
+
+# brotli es opcional: sin él se comprime solo con gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TIPOS_COMPRIMIBLES = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson')
+
+huellas_static = {}
+static_comprimidos = {}
+
+def etag_pagina(*partes):
+    # Incluye al usuario porque la barra de navegación cambia según la sesión
+    partes += (session.get("usuario_id"), session.get("usuario_nombre"), session.get("usuario_rol"))
+    return hashlib.sha1(repr(partes).encode()).hexdigest()[:20]
+
+def con_etag(respuesta, etag):
+    respuesta = make_response(respuesta)
+    respuesta.set_etag(etag, weak=True)
+    # El navegador puede guardarla pero tiene que revalidar en cada visita
+    respuesta.headers["Cache-Control"] = "private, no-cache"
+    return respuesta
+
+def respuesta_no_modificada(etag):
+    # Si el navegador ya tiene esta versión, 304 sin consultar ni renderizar nada
+    if request.if_none_match.contains_weak(etag):
+        return con_etag(Response(status=304), etag)
+    return None
+
+def huella_archivo(filename):
+    ruta = safe_join(current_app.static_folder, filename)
+    try:
+        modificado = os.stat(ruta).st_mtime
+    except (OSError, TypeError):
+        return None
+    huella = huellas_static.get(filename)
+    if huella is None or huella[0] != modificado:
+        with open(ruta, "rb") as archivo:
+            huella = (modificado, hashlib.md5(archivo.read()).hexdigest()[:10])
+        huellas_static[filename] = huella
+    return huella[1]
+
+@tienda.app_url_defaults
+def agregar_huella_static(endpoint, values):
+    # url_for('static', ...) agrega ?v=<hash del contenido>: si el archivo
+    # cambia, cambia la URL, así que se puede cachear sin vencimiento
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        huella = huella_archivo(values['filename'])
+        if huella:
+            values['v'] = huella
+
+def elegir_codificacion():
+    if brotli and 'br' in request.accept_encodings:
+        return 'br'
+    if 'gzip' in request.accept_encodings:
+        return 'gzip'
+    return None
+
+def comprimir(datos, codificacion):
+    if codificacion == 'br':
+        return brotli.compress(datos, quality=5)
+    return gzip.compress(datos, compresslevel=6)
+
+def static_comprimido(filename, codificacion):
+    # Los archivos estáticos se comprimen una sola vez y se guardan en memoria
+    ruta = safe_join(current_app.static_folder, filename)
+    clave = (ruta, os.stat(ruta).st_mtime, codificacion)
+    if clave not in static_comprimidos:
+        with open(ruta, "rb") as archivo:
+            static_comprimidos[clave] = comprimir(archivo.read(), codificacion)
+    return static_comprimidos[clave]
+
+@tienda.after_app_request
+def cache_http(respuesta):
+    es_static = request.endpoint == 'static'
+    if es_static and request.args.get('v') and respuesta.status_code in (200, 304):
+        respuesta.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+
+    codificacion = elegir_codificacion()
+    if (codificacion is None or respuesta.status_code != 200
+            or not (respuesta.mimetype or '').startswith(TIPOS_COMPRIMIBLES)
+            or 'Content-Encoding' in respuesta.headers or 'Range' in request.headers):
+        return respuesta
+
+    if es_static and respuesta.direct_passthrough:
+        datos = static_comprimido(request.view_args['filename'], codificacion)
+        respuesta.close()
+        etag, _ = respuesta.get_etag()
+        if etag:
+            respuesta.set_etag(f"{etag}-{codificacion}")
+    elif not respuesta.is_streamed:
+        datos = respuesta.get_data()
+        if len(datos) < 500:
+            return respuesta
+        datos = comprimir(datos, codificacion)
+    else:
+        return respuesta
+
+    respuesta.direct_passthrough = False
+    respuesta.set_data(datos)
+    respuesta.headers["Content-Encoding"] = codificacion
+    respuesta.vary.add("Accept-Encoding")
+    return respuesta
+
+# ============================
+# PLANTILLAS Y FRAGMENTOS
+# ============================
+
+# Las plantillas compiladas se guardan en disco: un worker nuevo no tiene que
+# volver a compilarlas. El bytecode se carga con marshal, así que la carpeta
+# tiene que ser solo de este usuario: nunca una ruta fija en /tmp
+def crear_cache_bytecode(carpeta):
+    if carpeta:
+        os.makedirs(carpeta, mode=0o700, exist_ok=True)
+        return FileSystemBytecodeCache(carpeta)
+    return FileSystemBytecodeCache()
+
+def renderizar(plantilla, **contexto):
+    # Sin pasar por render_template: un fragmento no es una página y no
+    # tiene que aparecer en las métricas de renderizado
+    return current_app.jinja_env.get_template(plantilla).render(**contexto)
+
+@tienda.app_template_global()
+def tarjetas_productos(productos):
+    """Devuelve el HTML de la tarjeta de cada producto del catálogo.
+
+    Cada tarjeta se cachea con la versión del producto, así que se invalida
+    sola cuando el admin lo edita; la URL de la imagen forma parte de la
+    clave porque cambia cuando terminan de generarse los tamaños.
+    """
+    if not current_app.config['FRAGMENTOS']:
+        return [Markup(renderizar('tarjeta_producto.html', p=p)) for p in productos]
+    versiones = cache.versiones_de([f"producto:{p['id']}:version" for p in productos])
+    claves = [f"tarjeta:{p['id']}:{version}:{imagen_url(p['imagen'], 'card')}"
+              for p, version in zip(productos, versiones)]
+    cacheadas = cache.get_many(claves)
+    tarjetas = []
+    for clave, p in zip(claves, productos):
+        html = cacheadas[clave]
+        if html is None:
+            html = renderizar('tarjeta_producto.html', p=p)
+            cache.set(clave, html)
+        tarjetas.append(Markup(html))
+    return tarjetas
+
+@tienda.app_template_global()
+@pass_context
+def fragmento(contexto, plantilla, *variantes):
+    # Navbar y footer cambian según el rol y unas pocas variables de la
+    # página (link activo, nombre del usuario): se cachea una copia por combinación
+    if not current_app.config['FRAGMENTOS']:
+        return Markup(renderizar(plantilla, **contexto.get_all()))
+    rol = session.get("usuario_rol") or "anonimo"
+    variante = hashlib.md5(json.dumps(variantes, default=str).encode()).hexdigest()[:12]
+    clave = f"fragmento:{plantilla}:{rol}:{variante}"
+    html = cache.get(clave)
+    if html is None:
+        html = renderizar(plantilla, **contexto.get_all())
+        cache.set(clave, html)
+    return Markup(html)
+
+# ============================
+# MÉTRICAS
+# ============================
+
+# Límites superiores (en segundos) de los buckets del histograma de latencia
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf"))
+
+# Junta los "IN (?, ?, ?)" de distinto largo en una misma forma de sentencia
+PATRON_LISTA_SQL = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s)\s*,)*\s*(?:\?|%s|%\(\w+\)s)\s*\)")
+
+class Metricas:
+    """Acumula tiempos por ruta, consultas SQL, renders y consultas lentas."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rutas = {}
+        self.consultas_lentas = deque(maxlen=100)
+        self.n_mas_uno = deque(maxlen=100)
+
+    def ruta(self, endpoint):
+        if endpoint not in self.rutas:
+            self.rutas[endpoint] = {"requests": 0, "segundos": 0.0, "buckets": [0] * len(BUCKETS_LATENCIA),
+                                    "sql": 0, "sql_segundos": 0.0, "plantillas_segundos": 0.0,
+                                    "n_mas_uno": 0, "lentas": 0}
+        return self.rutas[endpoint]
+
+    def registrar_request(self, endpoint, duracion, datos):
+        with self.lock:
+            ruta = self.ruta(endpoint)
+            ruta["requests"] += 1
+            ruta["segundos"] += duracion
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                if duracion <= limite:
+                    ruta["buckets"][i] += 1
+                    break
+            ruta["sql"] += datos["sql"]
+            ruta["sql_segundos"] += datos["sql_segundos"]
+            ruta["plantillas_segundos"] += datos["plantillas_segundos"]
+            ruta["lentas"] += datos["lentas"]
+            for sentencia, veces in datos["formas"].items():
+                if veces > current_app.config['N_MAS_UNO_UMBRAL']:
+                    ruta["n_mas_uno"] += 1
+                    self.n_mas_uno.append({"fecha": datetime.now().isoformat(timespec="seconds"),
+                                           "endpoint": endpoint, "veces": veces, "sentencia": sentencia})
+                    current_app.logger.warning("Posible N+1 en %s: %d veces %s", endpoint, veces, sentencia)
+
+    def registrar_lenta(self, endpoint, duracion, sentencia):
+        with self.lock:
+            self.consultas_lentas.append({"fecha": datetime.now().isoformat(timespec="seconds"),
+                                          "endpoint": endpoint, "ms": round(duracion * 1000, 1),
+                                          "sentencia": sentencia})
+        current_app.logger.warning("Consulta lenta (%.0f ms) en %s: %s", duracion * 1000, endpoint, sentencia)
+
+    def percentil(self, ruta, p):
+        # Aproximado: el límite del bucket donde cae el percentil
+        objetivo = ruta["requests"] * p
+        acumulado = 0
+        for limite, cantidad in zip(BUCKETS_LATENCIA, ruta["buckets"]):
+            acumulado += cantidad
+            if acumulado >= objetivo:
+                return limite
+        return float("inf")
+
+    def resumen(self):
+        with self.lock:
+            filas = []
+            for endpoint, ruta in sorted(self.rutas.items()):
+                n = ruta["requests"] or 1
+                filas.append({"endpoint": endpoint, "requests": ruta["requests"],
+                              "promedio_ms": round(ruta["segundos"] / n * 1000, 1),
+                              "p50_ms": self.percentil(ruta, 0.5) * 1000,
+                              "p95_ms": self.percentil(ruta, 0.95) * 1000,
+                              "sql_por_request": round(ruta["sql"] / n, 1),
+                              "sql_ms_por_request": round(ruta["sql_segundos"] / n * 1000, 1),
+                              "plantillas_ms_por_request": round(ruta["plantillas_segundos"] / n * 1000, 1),
+                              "n_mas_uno": ruta["n_mas_uno"], "lentas": ruta["lentas"]})
+            return filas, list(self.consultas_lentas), list(self.n_mas_uno)
+
+    def prometheus(self):
+        lineas = []
+        with self.lock:
+            rutas = {e: dict(r, buckets=list(r["buckets"])) for e, r in self.rutas.items()}
+        lineas.append("# TYPE tienda_request_duration_seconds histogram")
+        for endpoint, ruta in sorted(rutas.items()):
+            acumulado = 0
+            for limite, cantidad in zip(BUCKETS_LATENCIA, ruta["buckets"]):
+                acumulado += cantidad
+                le = "+Inf" if limite == float("inf") else limite
+                lineas.append(f'tienda_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {acumulado}')
+            lineas.append(f'tienda_request_duration_seconds_sum{{endpoint="{endpoint}"}} {ruta["segundos"]}')
+            lineas.append(f'tienda_request_duration_seconds_count{{endpoint="{endpoint}"}} {ruta["requests"]}')
+        for nombre, campo, tipo in (("tienda_sql_queries_total", "sql", "counter"),
+                                    ("tienda_sql_seconds_total", "sql_segundos", "counter"),
+                                    ("tienda_template_seconds_total", "plantillas_segundos", "counter"),
+                                    ("tienda_n_plus_one_total", "n_mas_uno", "counter"),
+                                    ("tienda_slow_queries_total", "lentas", "counter")):
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for endpoint, ruta in sorted(rutas.items()):
+                lineas.append(f'{nombre}{{endpoint="{endpoint}"}} {ruta[campo]}')
+        lineas.append("# TYPE tienda_cache_hits_total counter")
+        lineas.append(f"tienda_cache_hits_total {cache.aciertos}")
+        lineas.append("# TYPE tienda_cache_misses_total counter")
+        lineas.append(f"tienda_cache_misses_total {cache.fallos}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = de_la_app("metricas")
+
+def datos_request():
+    # Lo que se va midiendo durante el request actual (None fuera de un request)
+    if not has_request_context():
+        return None
+    return g.get("metricas")
+
+def inicio_request(sender, **extra):
+    g.metricas = {"inicio": time.perf_counter(), "sql": 0, "sql_segundos": 0.0,
+                  "plantillas_segundos": 0.0, "lentas": 0, "formas": {}, "renders": []}
+
+def fin_request(sender, response, **extra):
+    datos = datos_request()
+    if datos is not None:
+        metricas.registrar_request(request.endpoint or "desconocido",
+                                   time.perf_counter() - datos["inicio"], datos)
+
+def inicio_render(sender, template, context, **extra):
+    datos = datos_request()
+    if datos is not None:
+        datos["renders"].append(time.perf_counter())
+
+def fin_render(sender, template, context, **extra):
+    datos = datos_request()
+    if datos is not None and datos["renders"]:
+        datos["plantillas_segundos"] += time.perf_counter() - datos["renders"].pop()
+
+def antes_de_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("inicio_sql", []).append(time.perf_counter())
+
+def despues_de_sql(conn, cursor, statement, parameters, context, executemany):
+    duracion = time.perf_counter() - conn.info["inicio_sql"].pop()
+    datos = datos_request()
+    endpoint = request.endpoint if datos is not None else "fuera de request"
+    if datos is not None:
+        datos["sql"] += 1
+        datos["sql_segundos"] += duracion
+        forma = PATRON_LISTA_SQL.sub("(?)", statement)
+        datos["formas"][forma] = datos["formas"].get(forma, 0) + 1
+    if duracion * 1000 >= current_app.config['SQL_LENTA_MS']:
+        if datos is not None:
+            datos["lentas"] += 1
+        metricas.registrar_lenta(endpoint, duracion, statement)
+
+# Los hooks solo se registran si las métricas están activas: desactivadas no cuestan nada
+def registrar_metricas(app):
+    request_started.connect(inicio_request, app)
+    request_finished.connect(fin_request, app)
+    before_render_template.connect(inicio_render, app)
+    template_rendered.connect(fin_render, app)
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", antes_de_sql)
+            event.listen(engine, "after_cursor_execute", despues_de_sql)
+
+@tienda.route('/admin/metrics')
+@admin_required
+def admin_metricas():
+    rutas, lentas, n_mas_uno = metricas.resumen()
+    return render_template('admin_metricas.html', rutas=rutas, lentas=lentas, n_mas_uno=n_mas_uno,
+                           trabajos=resumen_trabajos(), activas=current_app.config['METRICAS'], section="metricas")
+
+@tienda.route('/metrics')
+def metricas_prometheus():
+    # Para Prometheus con METRICAS_TOKEN (como Bearer), o para un admin logueado
+    if not current_app.config['METRICAS']:
+        abort(404)
+    token = current_app.config['METRICAS_TOKEN']
+    con_token = bool(token) and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+    es_admin = "usuario_id" in session and rol_de_usuario(session["usuario_id"]) == "admin"
+    if not (con_token or es_admin):
+        abort(401)
+    return Response(metricas.prometheus() + metricas_trabajos(), mimetype="text/plain; version=0.0.4")
+
+# ============================
+# TRABAJOS EN SEGUNDO PLANO
+# ============================
+
+MANEJADORES = {}
+
+def trabajo(tipo):
+    # Registra la función que procesa un tipo de trabajo. Tiene que poder
+    # ejecutarse más de una vez con los mismos datos sin efectos duplicados.
+    def registrar(f):
+        MANEJADORES[tipo] = f
+        return f
+    return registrar
+
+def encolar(tipo, datos, clave=None):
+    """Agrega un trabajo a la sesión actual: se guarda con el próximo commit.
+
+    Con clave, un mismo trabajo no se encola dos veces.
+    """
+    if clave and db.session.query(Trabajo.id).filter_by(clave=clave).first():
+        return
+    db.session.add(Trabajo(tipo=tipo, datos=json.dumps(datos), clave=clave,
+                           max_intentos=current_app.config['TRABAJOS_REINTENTOS'], disponible_en=datetime.now()))
+    if has_request_context():
+        g.trabajos_encolados = True
+
+def tomar_trabajo(trabajo_id):
+    # Solo un worker puede pasar el trabajo de pendiente a en_curso
+    tomado = db.session.execute(
+        db.update(Trabajo)
+        .where(Trabajo.id == trabajo_id, Trabajo.estado == 'pendiente')
+        .values(estado='en_curso', empezado=datetime.now(), intentos=Trabajo.intentos + 1)
+    ).rowcount
+    db.session.commit()
+    return tomado == 1
+
+def ejecutar_trabajo(trabajo_id):
+    if not tomar_trabajo(trabajo_id):
+        return False
+    actual = db.session.get(Trabajo, trabajo_id)
+    try:
+        MANEJADORES[actual.tipo](json.loads(actual.datos))
+        actual.estado = 'hecho'
+        actual.terminado = datetime.now()
+        actual.error = None
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("Falló el trabajo %s (%s)", trabajo_id, actual.tipo)
+        actual = db.session.get(Trabajo, trabajo_id)
+        actual.error = repr(e)[:1000]
+        if actual.intentos >= actual.max_intentos:
+            actual.estado = 'fallido'
+            actual.terminado = datetime.now()
+        else:
+            # Reintento con espera exponencial: 10 s, 20 s, 40 s...
+            actual.estado = 'pendiente'
+            espera = current_app.config['TRABAJOS_ESPERA_BASE'] * 2 ** (actual.intentos - 1)
+            actual.disponible_en = datetime.now() + timedelta(seconds=espera)
+    db.session.commit()
+    return True
+
+def liberar_trabajos_colgados():
+    # Trabajos en curso de un worker que murió: vuelven a la cola
+    limite = datetime.now() - timedelta(seconds=current_app.config['TRABAJOS_TIMEOUT'])
+    Trabajo.query.filter(Trabajo.estado == 'en_curso', Trabajo.empezado < limite).update({"estado": "pendiente"})
+    db.session.commit()
+
+def procesar_trabajos(limite=100):
+    disponibles = [i for (i,) in db.session.query(Trabajo.id)
+                   .filter(Trabajo.estado == 'pendiente', Trabajo.disponible_en <= datetime.now())
+                   .order_by(Trabajo.id)
+                   .limit(limite)]
+    return sum(1 for trabajo_id in disponibles if ejecutar_trabajo(trabajo_id))
+
+@tienda.after_app_request
+def procesar_trabajos_sincronos(respuesta):
+    # Modo sincrónico (pruebas): los trabajos del request se hacen acá mismo
+    if current_app.config['TRABAJOS_MODO'] == 'sincrono' and g.get("trabajos_encolados"):
+        g.trabajos_encolados = False
+        procesar_trabajos()
+    return respuesta
+
+@tienda.cli.command("trabajos")
+@click.option("--workers", default=4, help="hilos que procesan trabajos")
+@click.option("--una-vez", is_flag=True, help="terminar cuando la cola quede vacía")
+def trabajador(workers, una_vez):
+    """Procesa la cola de trabajos en segundo plano."""
+    app = current_app._get_current_object()
+
+    def procesar():
+        with app.app_context():
+            while True:
+                liberar_trabajos_colgados()
+                procesados = procesar_trabajos(limite=10)
+                if not procesados:
+                    if una_vez:
+                        return
+                    time.sleep(1)
+
+    hilos = [threading.Thread(target=procesar, daemon=True) for _ in range(workers)]
+    for hilo in hilos:
+        hilo.start()
+    # Mientras los hilos trabajan, el principal borra cada hora los trabajos viejos
+    ultima_limpieza = None
+    while any(hilo.is_alive() for hilo in hilos):
+        if ultima_limpieza is None or time.monotonic() - ultima_limpieza > 3600:
+            with app.app_context():
+                limpiar_trabajos()
+            ultima_limpieza = time.monotonic()
+        time.sleep(1)
+
+def limpiar_trabajos():
+    """Borra los trabajos hechos hace más de TRABAJOS_RETENCION_DIAS, de a 1000."""
+    limite = datetime.now() - timedelta(days=current_app.config['TRABAJOS_RETENCION_DIAS'])
+    borrados = 0
+    while True:
+        ids = [i for (i,) in db.session.query(Trabajo.id)
+               .filter(Trabajo.estado == 'hecho', Trabajo.terminado < limite)
+               .limit(1000)]
+        if not ids:
+            return borrados
+        Trabajo.query.filter(Trabajo.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        borrados += len(ids)
+
+@tienda.cli.command("limpiar-trabajos")
+def limpiar_trabajos_viejos():
+    """Borra los trabajos hechos hace más de TRABAJOS_RETENCION_DIAS."""
+    print(f"Trabajos borrados: {limpiar_trabajos()}")
+
+def segundos_entre(desde, hasta):
+    # Diferencia entre dos columnas DATETIME, calculada por la base
+    dialecto = db.engine.dialect.name
+    if dialecto == 'mysql':
+        return db.func.timestampdiff(db.literal_column("MICROSECOND"), desde, hasta) / 1000000.0
+    if dialecto == 'postgresql':
+        return db.func.extract('epoch', hasta - desde)
+    return (db.func.julianday(hasta) - db.func.julianday(desde)) * 86400.0
+
+def resumen_trabajos():
+    por_estado = dict(db.session.query(Trabajo.estado, db.func.count()).group_by(Trabajo.estado).all())
+    # Latencia promedio (de encolado a terminado) de los trabajos de la última ventana:
+    # la calcula la base usando el índice (estado, terminado)
+    desde = datetime.now() - timedelta(seconds=current_app.config['TRABAJOS_VENTANA_LATENCIA'])
+    latencia = (db.session.query(db.func.avg(segundos_entre(Trabajo.creado, Trabajo.terminado)))
+                .filter(Trabajo.estado == 'hecho', Trabajo.terminado >= desde)
+                .scalar())
+    return {"estados": {e: por_estado.get(e, 0) for e in ('pendiente', 'en_curso', 'hecho', 'fallido')},
+            "latencia_promedio": float(latencia or 0.0)}
+
+def metricas_trabajos():
+    resumen = resumen_trabajos()
+    lineas = ["# TYPE tienda_jobs gauge"]
+    for estado, cantidad in resumen["estados"].items():
+        lineas.append(f'tienda_jobs{{estado="{estado}"}} {cantidad}')
+    lineas.append("# TYPE tienda_job_latency_seconds gauge")
+    lineas.append(f"tienda_job_latency_seconds {resumen['latencia_promedio']}")
+    return "\n".join(lineas) + "\n"
+
+@trabajo("stock_bajo")
+def avisar_stock_bajo(datos):
+    # Avisa qué productos del pedido quedaron por debajo del stock mínimo
+    bajos = (Producto.query
+             .filter(Producto.id.in_(datos["productos"]), Producto.stock < current_app.config['STOCK_MINIMO'])
+             .all())
+    for prod in bajos:
+        current_app.logger.warning("Stock bajo: %s (id %s) quedó con %s unidades", prod.nombre, prod.id, prod.stock)
+
+@trabajo("generar_imagenes")
+def trabajo_generar_imagenes(datos):
+    # generar_variantes saltea los tamaños que ya existen
+    if not generar_variantes(datos["imagen"], current_app.config['IMAGENES_CARPETA']):
+        current_app.logger.warning("No se pudieron generar los tamaños de %s", datos["imagen"])
+
 # ============================
 # HOME
 # ============================
 
-@app.route('/')
-def index():
-    busqueda = request.args.get('q', '').strip()
-    orden = request.args.get('orden', '')
-    categorias = request.args.getlist('categoria')
-    precio_max = request.args.get('precio', 50000)
+# Cantidad de productos por página del catálogo
+POR_PAGINA = 24
 
-    query = Producto.query
+busqueda_sqlite = {}
 
-    if busqueda:
-        query = query.filter(Producto.nombre.like(f'%{busqueda}%'))
+def hay_busqueda_sqlite():
+    # Las bases SQLite creadas antes de la tabla FTS5 siguen con LIKE
+    url = str(db.engine.url)
+    if url not in busqueda_sqlite:
+        busqueda_sqlite[url] = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'productos_busqueda'")).first() is not None
+    return busqueda_sqlite[url]
+
+def filtrar_busqueda(query, busqueda):
+    # Cada palabra tiene que aparecer (como prefijo) en el nombre o la
+    # descripción, en cualquier motor: MySQL usa el índice FULLTEXT, SQLite la
+    # tabla FTS5 y el resto un LIKE. Solo se pasan palabras: los operadores
+    # que escriba el usuario (- * + " etc.) son un error de sintaxis para MySQL
+    palabras = re.findall(r"\w+", busqueda)
+    if not palabras:
+        # Sin ninguna palabra (solo símbolos) se busca el texto tal cual
+        return query.filter(db.or_(Producto.nombre.like(f'%{busqueda}%'), Producto.descripcion.like(f'%{busqueda}%')))
+    dialecto = db.engine.dialect.name
+    if dialecto == 'mysql':
+        return query.filter(
+            db.text("MATCH (productos.nombre, productos.descripcion) AGAINST (:terminos IN BOOLEAN MODE)")
+            .bindparams(terminos=" ".join(f"+{t}*" for t in palabras))
+        )
+    if dialecto == 'sqlite' and hay_busqueda_sqlite():
+        return query.filter(
+            db.text("productos.id IN (SELECT rowid FROM productos_busqueda WHERE productos_busqueda MATCH :terminos)")
+            .bindparams(terminos=" ".join(f'"{t}"*' for t in palabras))
+        )
+    return query.filter(*[db.or_(Producto.nombre.like(f'%{t}%'), Producto.descripcion.like(f'%{t}%'))
+                          for t in palabras])
 
-    if categorias:
-        query = query.filter(Producto.categoria_id.in_(categorias))
+def leer_cursor(cursor, orden):
+    # El cursor es "precio_id" para los órdenes por precio y "id" para el resto
+    try:
+        if orden in ('mayor', 'menor'):
+            precio, ultimo_id = cursor.split('_')
+            return float(precio), int(ultimo_id)
+        return None, int(cursor)
+    except (ValueError, AttributeError):
+        return None
 
-    query = query.filter(Producto.precio <= precio_max)
+def paginar_catalogo(query, orden, cursor):
+    # Paginación por cursor (keyset): en lugar de OFFSET, seguimos desde la
+    # última fila vista, así cada página cuesta lo mismo sin importar su número.
+    posicion = leer_cursor(cursor, orden) if cursor else None
 
     if orden == 'mayor':
-        query = query.order_by(Producto.precio.desc())
+        if posicion:
+            precio, ultimo_id = posicion
+            query = query.filter(db.or_(Producto.precio < precio,
+                                        db.and_(Producto.precio == precio, Producto.id < ultimo_id)))
+        query = query.order_by(Producto.precio.desc(), Producto.id.desc())
     elif orden == 'menor':
-        query = query.order_by(Producto.precio.asc())
+        if posicion:
+            precio, ultimo_id = posicion
+            query = query.filter(db.or_(Producto.precio > precio,
+                                        db.and_(Producto.precio == precio, Producto.id > ultimo_id)))
+        query = query.order_by(Producto.precio.asc(), Producto.id.asc())
     elif orden == 'antiguo':
+        if posicion:
+            query = query.filter(Producto.id > posicion[1])
         query = query.order_by(Producto.id.asc())
     else:
+        if posicion:
+            query = query.filter(Producto.id < posicion[1])
         query = query.order_by(Producto.id.desc())
 
-    productos = query.all()
-    categorias_db = Categoria.query.all()
+    # Pedimos uno más para saber si hay página siguiente
+    productos = query.limit(POR_PAGINA + 1).all()
+    siguiente = None
+    if len(productos) > POR_PAGINA:
+        productos = productos[:POR_PAGINA]
+        ultimo = productos[-1]
+        if orden in ('mayor', 'menor'):
+            siguiente = f"{ultimo.precio}_{ultimo.id}"
+        else:
+            siguiente = str(ultimo.id)
+    return productos, siguiente
+
+# Rangos del histograma de precios (el slider del catálogo va de 0 a 50000)
+PRECIO_MAXIMO = 50000
+RANGOS_PRECIO = 10
+
+def filtros_catalogo():
+    return {
+        "busqueda": request.args.get('q', '').strip(),
+        "orden": request.args.get('orden', ''),
+        "categorias": request.args.getlist('categoria'),
+        "precio_max": request.args.get('precio', PRECIO_MAXIMO),
+        "cursor": request.args.get('despues', ''),
+    }
+
+def buscar_catalogo(filtros):
+    clave = clave_catalogo(filtros["busqueda"], filtros["orden"], filtros["categorias"],
+                           filtros["precio_max"], filtros["cursor"])
+    listado = cache.get(clave)
+
+    if listado is None:
+        query = Producto.query
+
+        if filtros["busqueda"]:
+            query = filtrar_busqueda(query, filtros["busqueda"])
+
+        if filtros["categorias"]:
+            query = query.filter(Producto.categoria_id.in_(filtros["categorias"]))
+
+        query = query.filter(Producto.precio <= filtros["precio_max"])
+
+        with desde_primario():
+            encontrados, siguiente = paginar_catalogo(query, filtros["orden"], filtros["cursor"])
+        guardar_productos(encontrados)
+        listado = {"ids": [p.id for p in encontrados], "siguiente": siguiente}
+        cache.set(clave, listado)
+
+    return obtener_productos(listado["ids"]), listado["siguiente"]
+
+def url_catalogo(endpoint, filtros, siguiente, **extra):
+    if not siguiente:
+        return None
+    return url_for(endpoint, q=filtros["busqueda"] or None, orden=filtros["orden"] or None,
+                   categoria=filtros["categorias"], precio=filtros["precio_max"], despues=siguiente, **extra)
 
-    return render_template(
+def facetas_catalogo(filtros):
+    """Cantidad de productos por categoría y un histograma de precios.
+
+    Sale de una sola consulta agrupada por categoría y rango de precio. Cada
+    faceta ignora su propio filtro: las categorías cuentan con el precio
+    máximo aplicado y el histograma con las categorías elegidas.
+    """
+    try:
+        precio_max = float(filtros["precio_max"])
+    except (TypeError, ValueError):
+        precio_max = PRECIO_MAXIMO
+    clave = "facetas:%s:%s" % (cache.version("catalogo:version"),
+                               json.dumps([filtros["busqueda"].lower(), precio_max]))
+    grupos = cache.get(clave)
+
+    if grupos is None:
+        ancho = PRECIO_MAXIMO / RANGOS_PRECIO
+        rango = db.case(*[(Producto.precio < ancho * (i + 1), i) for i in range(RANGOS_PRECIO - 1)],
+                        else_=RANGOS_PRECIO - 1)
+        hasta_precio = db.func.sum(db.case((Producto.precio <= precio_max, 1), else_=0))
+        query = db.session.query(Producto.categoria_id, rango, db.func.count(), hasta_precio)
+        if filtros["busqueda"]:
+            query = filtrar_busqueda(query, filtros["busqueda"])
+        with desde_primario():
+            filas = query.group_by(Producto.categoria_id, rango).all()
+        grupos = [[c, int(r), int(total), int(con_precio or 0)] for c, r, total, con_precio in filas]
+        cache.set(clave, grupos)
+
+    elegidas = {int(c) for c in filtros["categorias"] if str(c).isdigit()}
+    por_categoria = {}
+    histograma = [0] * RANGOS_PRECIO
+    for categoria_id, rango, total, con_precio in grupos:
+        por_categoria[categoria_id] = por_categoria.get(categoria_id, 0) + con_precio
+        if not elegidas or categoria_id in elegidas:
+            histograma[rango] += total
+    ancho = PRECIO_MAXIMO // RANGOS_PRECIO
+    return {
+        "categorias": [dict(c, cantidad=por_categoria.get(c["id"], 0)) for c in obtener_categorias()],
+        "histograma": [{"desde": i * ancho, "hasta": (i + 1) * ancho, "cantidad": cantidad}
+                       for i, cantidad in enumerate(histograma)],
+    }
+
+@tienda.route('/')
+@solo_lectura
+def index():
+    filtros = filtros_catalogo()
+
+    etag = etag_pagina("catalogo", cache.version("catalogo:version"), request.full_path)
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
+
+    productos, siguiente = buscar_catalogo(filtros)
+
+    return con_etag(render_template(
         "index.html",
         productos=productos,
-        categorias=categorias_db,
-        busqueda=busqueda,
-        precio_max=precio_max
-    )
+        categorias=facetas_catalogo(filtros)["categorias"],
+        busqueda=filtros["busqueda"],
+        orden=filtros["orden"],
+        precio_max=filtros["precio_max"],
+        url_siguiente=url_catalogo('tienda.index', filtros, siguiente),
+        url_api_siguiente=url_catalogo('tienda.api_catalogo', filtros, siguiente, formato='html')
+    ), etag)
+
+@tienda.route('/api/catalogo')
+@solo_lectura
+def api_catalogo():
+    # Mismos filtros que index(), pero devuelve solo la grilla (formato=html)
+    # o un JSON compacto con productos, facetas y, si se pide, la grilla ya renderizada
+    filtros = filtros_catalogo()
+    formato = request.args.get('formato', 'json')
+
+    etag = etag_pagina("api_catalogo", cache.version("catalogo:version"), request.full_path)
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
+
+    productos, siguiente = buscar_catalogo(filtros)
+
+    def grilla():
+        return render_template("grilla_productos.html", productos=productos,
+                               url_siguiente=url_catalogo('tienda.index', filtros, siguiente),
+                               url_api_siguiente=url_catalogo('tienda.api_catalogo', filtros, siguiente, formato='html'))
+
+    if formato == 'html':
+        return con_etag(grilla(), etag)
+
+    datos = {
+        "productos": [{"id": p["id"], "nombre": p["nombre"], "precio": p["precio"],
+                       "imagen": imagen_url(p["imagen"], 'card'), "url": url_for('tienda.producto', id=p["id"])}
+                      for p in productos],
+        "siguiente": url_catalogo('tienda.api_catalogo', filtros, siguiente),
+        "facetas": facetas_catalogo(filtros),
+    }
+    if request.args.get('incluir') == 'html':
+        datos["html"] = grilla()
+    return con_etag(jsonify(datos), etag)
 
 # ============================
 # PRODUCTO INDIVIDUAL
 # ============================
 
-@app.route("/producto/<int:id>")
+@tienda.route("/producto/<int:id>")
+@solo_lectura
 def producto(id):
-    prod = Producto.query.get_or_404(id)
-    return render_template("producto.html", producto=prod)
+    etag = etag_pagina("producto", id, cache.version(f"producto:{id}:version"))
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
+    prod = obtener_producto_o_404(id)
+    return con_etag(render_template("producto.html", producto=prod), etag)
 
 # ============================
 # CARRITO
 # ============================
 
-@app.route("/carrito")
+class CarritoMemoria:
+    """Carritos en un diccionario del proceso. Pensado para pruebas."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.carritos = {}
+        self.lock = threading.Lock()
+
+    def items(self, carrito_id):
+        with self.lock:
+            carrito = self.carritos.get(carrito_id)
+            if carrito is None or carrito[1] < time.monotonic() - self.ttl:
+                self.carritos.pop(carrito_id, None)
+                return {}
+            return dict(carrito[0])
+
+    def agregar(self, carrito_id, producto_id, cantidad):
+        with self.lock:
+            items = self.carritos.get(carrito_id, ({}, 0))[0]
+            items[producto_id] = items.get(producto_id, 0) + cantidad
+            self.carritos[carrito_id] = (items, time.monotonic())
+
+    def quitar(self, carrito_id, producto_id, todo=False):
+        with self.lock:
+            items = self.carritos.get(carrito_id, ({}, 0))[0]
+            if todo or items.get(producto_id, 0) <= 1:
+                items.pop(producto_id, None)
+            else:
+                items[producto_id] -= 1
+            self.carritos[carrito_id] = (items, time.monotonic())
+
+    def vaciar(self, carrito_id):
+        with self.lock:
+            self.carritos.pop(carrito_id, None)
+
+    def limpiar_vencidos(self):
+        limite = time.monotonic() - self.ttl
+        with self.lock:
+            vencidos = [c for c, (_, uso) in self.carritos.items() if uso < limite]
+            for carrito_id in vencidos:
+                del self.carritos[carrito_id]
+        return len(vencidos)
+
+
+class CarritoDB:
+    """Carritos en la tabla carrito_items, una fila por producto."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def limite(self):
+        return datetime.now() - timedelta(seconds=self.ttl)
+
+    def items(self, carrito_id):
+        filas = (db.session.query(CarritoItem.producto_id, CarritoItem.cantidad)
+                 .filter(CarritoItem.carrito_id == carrito_id, CarritoItem.actualizado >= self.limite())
+                 .all())
+        return dict(filas)
+
+    def tocar(self, carrito_id):
+        # Cualquier cambio renueva el vencimiento de todo el carrito
+        CarritoItem.query.filter_by(carrito_id=carrito_id).update({"actualizado": datetime.now()})
+
+    def agregar(self, carrito_id, producto_id, cantidad):
+        item = db.session.get(CarritoItem, (carrito_id, producto_id))
+        if item:
+            item.cantidad = item.cantidad + cantidad
+        else:
+            db.session.add(CarritoItem(carrito_id=carrito_id, producto_id=producto_id, cantidad=cantidad))
+        db.session.flush()
+        self.tocar(carrito_id)
+        db.session.commit()
+
+    def quitar(self, carrito_id, producto_id, todo=False):
+        item = db.session.get(CarritoItem, (carrito_id, producto_id))
+        if item:
+            if todo or item.cantidad <= 1:
+                db.session.delete(item)
+            else:
+                item.cantidad = item.cantidad - 1
+            db.session.flush()
+            self.tocar(carrito_id)
+            db.session.commit()
+
+    def vaciar(self, carrito_id):
+        CarritoItem.query.filter_by(carrito_id=carrito_id).delete()
+        db.session.commit()
+
+    def limpiar_vencidos(self):
+        borrados = CarritoItem.query.filter(CarritoItem.actualizado < self.limite()).delete()
+        db.session.commit()
+        return borrados
+
+
+def crear_carritos(config):
+    if config['CARRITO_BACKEND'] == 'memoria':
+        return CarritoMemoria(config['CARRITO_TTL'])
+    return CarritoDB(config['CARRITO_TTL'])
+
+carritos = de_la_app("carritos")
+
+def carrito_actual():
+    # La cookie de sesión solo guarda el id del carrito, no su contenido
+    if "carrito_id" not in session:
+        session["carrito_id"] = uuid.uuid4().hex
+    return session["carrito_id"]
+
+def armar_carrito(cantidades):
+    # Nombres, imágenes y precios actuales salen de la caché de productos,
+    # que trae los que falten en una sola consulta
+    items = []
+    for prod in obtener_productos(sorted(cantidades)):
+        items.append(dict(prod, cantidad=cantidades[prod["id"]]))
+    total = sum(item["precio"] * item["cantidad"] for item in items)
+    return items, total
+
+@tienda.cli.command("limpiar-carritos")
+def limpiar_carritos():
+    """Borra los carritos abandonados (más viejos que CARRITO_TTL)."""
+    print(f"Carritos vencidos borrados: {carritos.limpiar_vencidos()}")
+
+@tienda.route("/carrito")
 def carrito():
-    carrito = session.get("carrito", [])
-    total = sum(item["precio"] * item.get("cantidad", 1) for item in carrito)
-    return render_template("carrito.html", items=carrito, total=total)
+    items, total = armar_carrito(carritos.items(carrito_actual()))
+    return render_template("carrito.html", items=items, total=total)
 
-@app.route("/agregar_carrito/<int:id>", methods=["POST"])
+@tienda.route("/agregar_carrito/<int:id>", methods=["POST"])
 def agregar_carrito(id):
-    producto = Producto.query.get_or_404(id)
+    producto = obtener_producto_o_404(id)
     try:
         cantidad = int(request.form.get("cantidad", 1))
     except (ValueError, TypeError):
@@ -159,62 +1592,51 @@ def agregar_carrito(id):
     if cantidad < 1:
         cantidad = 1
 
-    carrito = session.get("carrito", [])
-    found = False
-    for it in carrito:
-        if it["id"] == producto.id:
-            it["cantidad"] = it.get("cantidad", 1) + cantidad
-            found = True
-            break
-    if not found:
-        carrito.append({
-            "id": producto.id,
-            "nombre": producto.nombre,
-            "precio": float(producto.precio),
-            "imagen": producto.imagen,
-            "cantidad": cantidad
-        })
-    session["carrito"] = carrito
-    return redirect(url_for("carrito"))
+    carritos.agregar(carrito_actual(), producto["id"], cantidad)
+    return redirect(url_for("tienda.carrito"))
 
-@app.route("/carrito/eliminar/<int:id>", methods=["POST"])
+@tienda.route("/carrito/eliminar/<int:id>", methods=["POST"])
 def eliminar_carrito(id):
-    carrito = session.get("carrito", [])
     eliminar_todo = request.form.get("toda", "0") == "1"
-    nuevo = []
-    for item in carrito:
-        if item["id"] != id:
-            nuevo.append(item)
-        else:
-            if eliminar_todo:
-                pass
-            else:
-                if item.get("cantidad", 1) > 1:
-                    item["cantidad"] = item.get("cantidad", 1) - 1
-                    nuevo.append(item)
-    session["carrito"] = nuevo
-    return redirect(url_for("carrito"))
+    carritos.quitar(carrito_actual(), id, todo=eliminar_todo)
+    return redirect(url_for("tienda.carrito"))
 
 # ============================
 # ADMIN
 # ============================
 
-@app.route('/admin')
+@tienda.route('/admin')
 @admin_required
 def admin_dashboard():
-    return redirect(url_for('admin_pedidos'))
+    return redirect(url_for('tienda.admin_pedidos'))
 
-@app.route('/admin/productos')
+# Productos por página en el panel
+PRODUCTOS_POR_PAGINA_ADMIN = 50
+
+@tienda.route('/admin/productos')
+@solo_lectura
 @admin_required
 def admin_productos():
-    productos = Producto.query.all()
-    return render_template('admin_productos.html', productos=productos, section="productos")
+    busqueda = request.args.get('q', '').strip()
+    categoria = request.args.get('categoria', '')
+    pagina = request.args.get('pagina', 1, type=int)
+    query = Producto.query.options(joinedload(Producto.categoria))
+    if busqueda:
+        query = filtrar_busqueda(query, busqueda)
+    if categoria:
+        query = query.filter(Producto.categoria_id == categoria)
+    productos = query.order_by(Producto.id.desc()).paginate(page=pagina, per_page=PRODUCTOS_POR_PAGINA_ADMIN,
+                                                            error_out=False)
+    filtros_url = {k: v for k, v in (('q', busqueda), ('categoria', categoria)) if v}
+    return render_template('admin_productos.html', productos=productos.items, paginacion=productos,
+                           busqueda=busqueda, categoria=categoria, categorias=obtener_categorias(),
+                           filtros_url=filtros_url, section="productos")
 
-@app.route('/admin/productos/editar/<int:id>', methods=['GET', 'POST'])
+@tienda.route('/admin/productos/editar/<int:id>', methods=['GET', 'POST'])
 @admin_required
 def admin_editar_producto(id):
     producto = Producto.query.get_or_404(id)
-    categorias = Categoria.query.all()
+    categorias = obtener_categorias()
     if request.method == 'POST':
         producto.nombre = request.form['nombre']
         producto.precio = request.form['precio']
@@ -222,26 +1644,25 @@ def admin_editar_producto(id):
         producto.descripcion = request.form['descripcion']
         producto.categoria_id = request.form['categoria_id']
         if "imagen" in request.files and request.files["imagen"].filename != "":
-            archivo = request.files["imagen"]
-            filename = secure_filename(archivo.filename)
-            archivo.save(os.path.join("static/img", filename))
-            producto.imagen = filename
+            producto.imagen = guardar_imagen(request.files["imagen"])
         db.session.commit()
-        return redirect(url_for('admin_productos'))
+        invalidar_productos(producto.id)
+        return redirect(url_for('tienda.admin_productos'))
     return render_template('admin_editar_producto.html', producto=producto, categorias=categorias, section="productos")
 
-@app.route('/admin/productos/eliminar/<int:id>', methods=['POST'])
+@tienda.route('/admin/productos/eliminar/<int:id>', methods=['POST'])
 @admin_required
 def admin_eliminar_producto(id):
     producto = Producto.query.get_or_404(id)
     db.session.delete(producto)
     db.session.commit()
-    return redirect(url_for('admin_productos'))
+    invalidar_productos(id)
+    return redirect(url_for('tienda.admin_productos'))
 
-@app.route('/admin/productos/agregar', methods=['GET', 'POST'])
+@tienda.route('/admin/productos/agregar', methods=['GET', 'POST'])
 @admin_required
 def admin_agregar_producto():
-    categorias = Categoria.query.all()
+    categorias = obtener_categorias()
     if request.method == 'POST':
         nombre = request.form['nombre']
         descripcion = request.form['descripcion']
@@ -251,8 +1672,7 @@ def admin_agregar_producto():
         imagen_archivo = request.files.get("imagen")
         filename = None
         if imagen_archivo and imagen_archivo.filename != "":
-            filename = secure_filename(imagen_archivo.filename)
-            imagen_archivo.save(os.path.join("static/img", filename))
+            filename = guardar_imagen(imagen_archivo)
         nuevo = Producto(
             nombre=nombre,
             descripcion=descripcion,
@@ -263,24 +1683,322 @@ def admin_agregar_producto():
         )
         db.session.add(nuevo)
         db.session.commit()
-        return redirect(url_for('admin_productos'))
+        invalidar_productos(nuevo.id)
+        return redirect(url_for('tienda.admin_productos'))
     return render_template('admin_agregar_producto.html', categorias=categorias, section="productos")
 
-@app.route("/admin/usuarios")
+# ============================
+# IMPORTACIÓN Y STOCK EN LOTE
+# ============================
+
+# Filas por transacción al importar y ajustes por UPDATE al cambiar stock
+LOTE_IMPORTACION = 500
+LOTE_STOCK = 1000
+# Errores por fila que se muestran como máximo (el total se cuenta igual)
+MAX_ERRORES_MOSTRADOS = 200
+
+COLUMNAS_PRODUCTO = ["id", "nombre", "descripcion", "precio", "stock", "imagen", "categoria"]
+# Límites de las columnas: precio DECIMAL(10,2) y stock INT
+PRECIO_LIMITE = Decimal("99999999.99")
+STOCK_LIMITE = 2 ** 31 - 1
+
+class FilaIlegible:
+    """Una línea JSON mal formada: se informa como error de esa fila."""
+
+    def __init__(self, error):
+        self.error = error
+
+def leer_filas(archivo):
+    # Devuelve (número de línea, fila) de a una, sin cargar el archivo entero:
+    # CSV con encabezado o JSON (una fila por línea, o una lista si es chico)
+    texto = io.TextIOWrapper(archivo.stream, encoding="utf-8-sig")
+    if not archivo.filename.lower().endswith((".json", ".ndjson", ".jsonl")):
+        lector = csv.DictReader(texto)
+        for fila in lector:
+            yield lector.line_num, fila
+        return
+    numero = 1
+    primero = texto.read(1)
+    while primero.isspace():
+        numero += primero == "\n"
+        primero = texto.read(1)
+    if primero == "[":
+        yield from enumerate(json.loads(primero + texto.read()), start=1)
+        return
+    linea = primero + texto.readline()
+    while linea:
+        if linea.strip():
+            try:
+                fila = json.loads(linea)
+            except ValueError as e:
+                fila = FilaIlegible(str(e))
+            yield numero, fila
+        numero += 1
+        linea = texto.readline()
+
+def validar_producto(fila):
+    # Devuelve (datos, None) o (None, mensaje de error)
+    if isinstance(fila, FilaIlegible):
+        return None, f"JSON inválido: {fila.error}"
+    if not isinstance(fila, dict):
+        return None, "la fila no es un objeto"
+    nombre = str(fila.get("nombre") or "").strip()
+    if not nombre:
+        return None, "falta el nombre"
+    if len(nombre) > 100:
+        return None, "el nombre supera los 100 caracteres"
+    try:
+        precio = Decimal(str(fila.get("precio", "")).strip())
+        if not precio.is_finite() or precio < 0 or precio > PRECIO_LIMITE:
+            raise InvalidOperation
+    except InvalidOperation:
+        return None, f"precio inválido: {fila.get('precio')!r}"
+    try:
+        stock = int(str(fila.get("stock") or 0).strip())
+        if stock < 0 or stock > STOCK_LIMITE:
+            raise ValueError
+    except ValueError:
+        return None, f"stock inválido: {fila.get('stock')!r}"
+    producto_id = str(fila.get("id") or "").strip()
+    if producto_id and (not producto_id.isdigit() or int(producto_id) > STOCK_LIMITE):
+        return None, f"id inválido: {producto_id!r}"
+    return {
+        "id": int(producto_id) if producto_id else None,
+        "nombre": nombre,
+        "descripcion": fila.get("descripcion") or None,
+        "precio": precio,
+        "stock": stock,
+        "imagen": fila.get("imagen") or None,
+        "categoria": str(fila.get("categoria") or "").strip(),
+        # Al actualizar solo se pisan las columnas que vinieron en la fila
+        "presentes": {k for k in ("descripcion", "stock", "imagen", "categoria") if fila.get(k) not in (None, "")},
+    }, None
+
+def guardar_lote_productos(lote, categorias_por_nombre, resultado):
+    # Si el lote falla no se toca nada: las categorías y los contadores se
+    # actualizan recién después del commit
+    categorias = dict(categorias_por_nombre)
+    # Categorías nuevas del lote: se crean todas juntas
+    nuevas = sorted({d["categoria"] for _, d in lote if d["categoria"] and d["categoria"] not in categorias})
+    if nuevas:
+        db.session.execute(db.insert(Categoria), [{"nombre": n} for n in nuevas])
+        for c in Categoria.query.filter(Categoria.nombre.in_(nuevas)):
+            categorias[c.nombre] = c.id
+
+    ids = [d["id"] for _, d in lote if d["id"]]
+    existentes = {i for (i,) in db.session.query(Producto.id).filter(Producto.id.in_(ids))} if ids else set()
+    insertar, actualizar = [], {}
+    for _, datos in lote:
+        fila = {k: datos[k] for k in ("nombre", "descripcion", "precio", "stock", "imagen")}
+        fila["categoria_id"] = categorias.get(datos["categoria"])
+        if datos["id"] in existentes:
+            columnas = {"id", "nombre", "precio"} | {"categoria_id" if k == "categoria" else k for k in datos["presentes"]}
+            fila = {k: v for k, v in dict(fila, id=datos["id"]).items() if k in columnas}
+            # Se agrupan por columnas para que cada grupo sea un solo executemany
+            actualizar.setdefault(tuple(sorted(columnas)), []).append(fila)
+        else:
+            if datos["id"]:
+                fila["id"] = datos["id"]
+            insertar.append(fila)
+    if insertar:
+        db.session.execute(db.insert(Producto), insertar)
+    for filas in actualizar.values():
+        # UPDATE por clave primaria en lote
+        db.session.execute(db.update(Producto), filas)
+    db.session.commit()
+    categorias_por_nombre.update(categorias)
+    actualizados = [f["id"] for filas in actualizar.values() for f in filas]
+    resultado["categorias_nuevas"] += len(nuevas)
+    resultado["insertados"] += len(insertar)
+    resultado["actualizados"] += len(actualizados)
+    return actualizados
+
+def importar_productos(archivo):
+    resultado = {"insertados": 0, "actualizados": 0, "categorias_nuevas": 0, "errores": [], "total_errores": 0}
+    categorias_por_nombre = {c["nombre"]: c["id"] for c in obtener_categorias()}
+    lote, ids_lote, actualizados = [], {}, []
+
+    def registrar_error(numero, mensaje):
+        resultado["total_errores"] += 1
+        if len(resultado["errores"]) < MAX_ERRORES_MOSTRADOS:
+            resultado["errores"].append({"fila": numero, "error": mensaje})
+
+    def guardar(lote):
+        try:
+            return guardar_lote_productos(lote, categorias_por_nombre, resultado)
+        except (IntegrityError, DataError):
+            db.session.rollback()
+        # Algo del lote no entró: se reintenta de a una fila para saber cuál
+        guardados = []
+        for numero, datos in lote:
+            try:
+                guardados += guardar_lote_productos([(numero, datos)], categorias_por_nombre, resultado)
+            except (IntegrityError, DataError) as e:
+                db.session.rollback()
+                registrar_error(numero, f"no se pudo guardar: {getattr(e, 'orig', e)}")
+        return guardados
+
+    numero = 0
+    try:
+        for numero, fila in leer_filas(archivo):
+            datos, error = validar_producto(fila)
+            if not error and datos["id"] in ids_lote:
+                error = f"id {datos['id']} repetido (ya está en la fila {ids_lote[datos['id']]})"
+            if error:
+                registrar_error(numero, error)
+                continue
+            if datos["id"]:
+                ids_lote[datos["id"]] = numero
+            lote.append((numero, datos))
+            if len(lote) >= LOTE_IMPORTACION:
+                actualizados += guardar(lote)
+                lote, ids_lote = [], {}
+        if lote:
+            actualizados += guardar(lote)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        # El archivo no se puede seguir leyendo: se guarda lo ya validado y
+        # se informa a partir de qué línea se cortó
+        if lote:
+            actualizados += guardar(lote)
+        registrar_error(numero + 1, f"no se pudo seguir leyendo el archivo desde acá: {e}")
+
+    invalidar_productos(*actualizados)
+    if resultado["categorias_nuevas"]:
+        invalidar_categorias()
+    return resultado
+
+@tienda.route('/admin/productos/importar', methods=['GET', 'POST'])
+@admin_required
+def admin_importar_productos():
+    resultado = None
+    if request.method == 'POST' and request.files.get("archivo") and request.files["archivo"].filename:
+        resultado = importar_productos(request.files["archivo"])
+    return render_template('admin_importar_productos.html', resultado=resultado, section="productos")
+
+@tienda.route('/admin/productos/exportar')
+@solo_lectura
+@admin_required
+def admin_exportar_productos():
+    formato = request.args.get("formato", "csv")
+    consulta = (db.select(Producto.id, Producto.nombre, Producto.descripcion, Producto.precio,
+                          Producto.stock, Producto.imagen, Categoria.nombre)
+                .outerjoin(Categoria, Producto.categoria_id == Categoria.id)
+                .order_by(Producto.id)
+                .execution_options(yield_per=1000))
+
+    def generar_csv():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(COLUMNAS_PRODUCTO)
+        for fila in db.session.execute(consulta):
+            escritor.writerow(fila)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def generar_ndjson():
+        for fila in db.session.execute(consulta):
+            datos = dict(zip(COLUMNAS_PRODUCTO, fila))
+            datos["precio"] = float(datos["precio"])
+            yield json.dumps(datos, ensure_ascii=False) + "\n"
+
+    if formato == "ndjson":
+        return Response(stream_with_context(generar_ndjson()), mimetype="application/x-ndjson",
+                        headers={"Content-Disposition": "attachment; filename=productos.ndjson"})
+    return Response(stream_with_context(generar_csv()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=productos.csv"})
+
+def ajustar_stock(ajustes):
+    """Suma a cada producto su delta de stock, de a LOTE_STOCK productos por UPDATE.
+
+    ajustes es un diccionario producto_id -> delta. No se aplica un ajuste
+    que deje el stock negativo ni uno sobre un producto que no existe.
+    """
+    resultado = {"aplicados": 0, "errores": []}
+    ids = sorted(ajustes)
+    for inicio in range(0, len(ids), LOTE_STOCK):
+        tramo = ids[inicio:inicio + LOTE_STOCK]
+        actuales = dict(db.session.query(Producto.id, Producto.stock).filter(Producto.id.in_(tramo)))
+        validos = {}
+        for producto_id in tramo:
+            if producto_id not in actuales:
+                resultado["errores"].append({"id": producto_id, "error": "no existe"})
+            elif (actuales[producto_id] or 0) + ajustes[producto_id] < 0:
+                resultado["errores"].append({"id": producto_id, "error": "el stock quedaría negativo"})
+            else:
+                validos[producto_id] = ajustes[producto_id]
+        if not validos:
+            continue
+        delta = db.case(validos, value=Producto.id)
+        aplicados = db.session.execute(
+            db.update(Producto)
+            .where(Producto.id.in_(list(validos)), Producto.stock + delta >= 0)
+            .values(stock=Producto.stock + delta)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        resultado["aplicados"] += aplicados
+        if aplicados < len(validos):
+            resultado["errores"].append({"id": None, "error": f"{len(validos) - aplicados} ajustes no se aplicaron "
+                                                              "porque el stock cambió mientras tanto"})
+        invalidar_productos(*validos, listados=False)
+    return resultado
+
+@tienda.route('/admin/productos/stock', methods=['POST'])
+@admin_required
+def admin_ajustar_stock():
+    # Acepta JSON {"ajustes": [{"id": 1, "delta": -3}, ...]} o un CSV con columnas id,delta
+    ajustes, errores = {}, []
+    if request.is_json:
+        cuerpo = request.get_json(silent=True)
+        filas = cuerpo.get("ajustes", []) if isinstance(cuerpo, dict) else None
+        if not isinstance(filas, list):
+            return jsonify({"error": 'se espera un objeto {"ajustes": [...]}'}), 400
+        filas = enumerate(filas, start=1)
+    else:
+        archivo = request.files.get("archivo")
+        filas = leer_filas(archivo) if archivo and archivo.filename else []
+    numero = 0
+    try:
+        for numero, fila in filas:
+            if isinstance(fila, FilaIlegible):
+                errores.append({"fila": numero, "error": f"JSON inválido: {fila.error}"})
+                continue
+            try:
+                producto_id, delta = int(fila["id"]), int(fila["delta"])
+            except (KeyError, TypeError, ValueError):
+                errores.append({"fila": numero, "error": "se esperan id y delta enteros"})
+                continue
+            ajustes[producto_id] = ajustes.get(producto_id, 0) + delta
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        # Se aplican los ajustes leídos hasta acá
+        errores.append({"fila": numero + 1, "error": f"no se pudo seguir leyendo el archivo desde acá: {e}"})
+
+    resultado = ajustar_stock(ajustes)
+    resultado["errores"] = errores + resultado["errores"]
+    if request.is_json:
+        return jsonify(resultado)
+    return render_template('admin_importar_productos.html', stock=resultado, section="productos")
+
+@tienda.route("/admin/usuarios")
+@solo_lectura
 @admin_required
 def admin_usuarios():
     usuarios = Usuario.query.all()
     return render_template("admin_usuarios.html", usuarios=usuarios, section="usuarios")
 
-@app.route("/admin/usuarios/eliminar/<int:id>", methods=["POST"])
+@tienda.route("/admin/usuarios/eliminar/<int:id>", methods=["POST"])
 @admin_required
 def admin_eliminar_usuario(id):
     usuario = Usuario.query.get_or_404(id)
     db.session.delete(usuario)
     db.session.commit()
-    return redirect(url_for("admin_usuarios"))
+    invalidar_usuario(id)
+    return redirect(url_for("tienda.admin_usuarios"))
 
-@app.route("/admin/usuarios/editar/<int:id>", methods=["GET", "POST"])
+@tienda.route("/admin/usuarios/editar/<int:id>", methods=["GET", "POST"])
 @admin_required
 def admin_editar_usuario(id):
     usuario = Usuario.query.get_or_404(id)
@@ -289,94 +2007,524 @@ def admin_editar_usuario(id):
         usuario.email = request.form["email"]
         usuario.rol = request.form["rol"]
         db.session.commit()
-        return redirect(url_for("admin_usuarios"))
+        invalidar_usuario(id)
+        return redirect(url_for("tienda.admin_usuarios"))
     return render_template("editar_usuario.html", usuario=usuario)
 
-@app.route('/admin/reportes')
+# ============================
+# REPORTES DE VENTAS
+# ============================
+
+def periodos(fecha):
+    # Un pedido suma en su día y en su mes
+    dia = fecha.date() if isinstance(fecha, datetime) else fecha
+    return [("dia", dia), ("mes", dia.replace(day=1))]
+
+def acumular_venta(acumulado, fecha, lineas, signo=1):
+    # Suma las líneas de un pedido en un diccionario
+    # (tipo, dimension, clave_id, periodo) -> [pedidos, unidades, ingresos]
+    categorias = {}
+    for producto_id, categoria_id, cantidad, precio in lineas:
+        subtotal = precio * cantidad
+        cat = categorias.setdefault(categoria_id or 0, [0, 0])
+        cat[0] += cantidad
+        cat[1] += subtotal
+        for tipo, periodo in periodos(fecha):
+            fila = acumulado.setdefault((tipo, "producto", producto_id, periodo), [0, 0, 0])
+            fila[0] += signo
+            fila[1] += signo * cantidad
+            fila[2] += signo * subtotal
+    for tipo, periodo in periodos(fecha):
+        for categoria_id, (unidades, ingresos) in categorias.items():
+            fila = acumulado.setdefault((tipo, "categoria", categoria_id, periodo), [0, 0, 0])
+            fila[0] += signo
+            fila[1] += signo * unidades
+            fila[2] += signo * ingresos
+        fila = acumulado.setdefault((tipo, "total", 0, periodo), [0, 0, 0])
+        fila[0] += signo
+        fila[1] += signo * sum(u for u, _ in categorias.values())
+        fila[2] += signo * sum(i for _, i in categorias.values())
+    return acumulado
+
+def sumar_resumenes(acumulado):
+    """Suma las filas acumuladas a resumen_ventas con un único upsert.
+
+    Las claves van ordenadas: dos transacciones que tocan las mismas filas
+    las bloquean en el mismo orden y no se traban entre sí. Al ser un solo
+    INSERT ... ON DUPLICATE KEY UPDATE tampoco hay una ventana entre el
+    UPDATE y el INSERT en la que dos pedidos creen la misma fila.
+    """
+    if not acumulado:
+        return
+    filas = [{"tipo": t, "dimension": d, "clave_id": c, "periodo": p,
+              "pedidos": v[0], "unidades": v[1], "ingresos": v[2]}
+             for (t, d, c, p), v in sorted(acumulado.items())]
+    db.session.execute(insertar_o_sumar(ResumenVenta, filas, ["pedidos", "unidades", "ingresos"]))
+
+def registrar_venta(fecha, lineas, signo=1):
+    """Actualiza los resúmenes con un pedido, dentro de la transacción actual.
+
+    lineas es una lista de (producto_id, categoria_id, cantidad, precio_unitario);
+    signo -1 descuenta un pedido que se cancela.
+    """
+    sumar_resumenes(acumular_venta({}, fecha, lineas, signo))
+
+def lineas_de_pedido(pedido_id):
+    return (db.session.query(DetallePedido.producto_id, Producto.categoria_id,
+                             DetallePedido.cantidad, DetallePedido.precio_unitario)
+            .join(Producto, DetallePedido.producto_id == Producto.id)
+            .filter(DetallePedido.pedido_id == pedido_id)
+            .all())
+
+@trabajo("resumen_venta")
+def trabajo_resumen_venta(datos):
+    # Fuera de la compra: las filas de totales del día y del mes las toca cada
+    # pedido, y bloquearlas dentro del checkout pondría en fila a todas las compras.
+    # El trabajo se marca hecho en la misma transacción, así que no suma dos veces.
+    pedido = db.session.get(Pedido, datos["pedido_id"])
+    if pedido:
+        registrar_venta(pedido.fecha, lineas_de_pedido(pedido.id), datos["signo"])
+
+def periodo_sql(tipo):
+    # El día o el primer día del mes de cada pedido, calculado por la base
+    if tipo == "dia":
+        return db.func.date(Pedido.fecha)
+    if db.engine.dialect.name == 'mysql':
+        return db.func.date_format(Pedido.fecha, '%Y-%m-01')
+    return db.func.strftime('%Y-%m-01', Pedido.fecha)
+
+def reconstruir_resumen_ventas():
+    """Recalcula resumen_ventas a partir de todos los pedidos no cancelados.
+
+    Cada combinación de período y dimensión es un INSERT ... SELECT ... GROUP BY:
+    la suma la hace la base y no pasa ninguna fila por Python. Conviene
+    correrlo con la cola de trabajos vacía, si no los resúmenes pendientes
+    se sumarían dos veces.
+    """
+    db.session.execute(db.delete(ResumenVenta))
+    claves = {
+        "total": None,
+        "producto": DetallePedido.producto_id,
+        "categoria": db.func.coalesce(Producto.categoria_id, 0),
+    }
+    for tipo in ("dia", "mes"):
+        periodo = periodo_sql(tipo)
+        for dimension, clave in claves.items():
+            consulta = (db.select(db.literal(tipo), db.literal(dimension),
+                                  clave if clave is not None else db.literal(0), periodo,
+                                  db.func.count(db.distinct(Pedido.id)),
+                                  db.func.sum(DetallePedido.cantidad),
+                                  db.func.sum(DetallePedido.cantidad * DetallePedido.precio_unitario))
+                        .select_from(Pedido)
+                        .join(DetallePedido, DetallePedido.pedido_id == Pedido.id)
+                        .join(Producto, DetallePedido.producto_id == Producto.id)
+                        .where(Pedido.estado != 'cancelado')
+                        .group_by(*([clave, periodo] if clave is not None else [periodo])))
+            db.session.execute(db.insert(ResumenVenta).from_select(
+                ["tipo", "dimension", "clave_id", "periodo", "pedidos", "unidades", "ingresos"], consulta))
+    db.session.commit()
+    return db.session.query(db.func.count()).select_from(ResumenVenta).scalar()
+
+@tienda.cli.command("reconstruir-resumenes")
+def reconstruir_resumenes():
+    """Recalcula resumen_ventas a partir de todos los pedidos no cancelados."""
+    print(f"Resúmenes generados: {reconstruir_resumen_ventas()}")
+
+@tienda.route('/admin/reportes')
 @admin_required
 def admin_reportes():
     return render_template('admin_reportes.html', section="reportes")
 
-@app.route("/admin/pedidos")
+@tienda.route('/admin/reportes/datos')
+@solo_lectura
+@admin_required
+def admin_reportes_datos():
+    granularidad = request.args.get("granularidad", "mes")
+    if granularidad not in ("dia", "mes"):
+        granularidad = "mes"
+    dimension = request.args.get("dimension", "total")
+    if dimension not in ("total", "producto", "categoria"):
+        dimension = "total"
+    hasta = leer_fecha(request.args.get("hasta")) or datetime.now()
+    desde = leer_fecha(request.args.get("desde")) or hasta - timedelta(days=365)
+    inicio = desde.date() if granularidad == "dia" else desde.date().replace(day=1)
+
+    condiciones = [ResumenVenta.tipo == granularidad, ResumenVenta.dimension == dimension,
+                   ResumenVenta.periodo >= inicio, ResumenVenta.periodo <= hasta.date()]
+
+    if dimension == "total":
+        filas = (db.session.query(ResumenVenta.periodo, ResumenVenta.pedidos,
+                                  ResumenVenta.unidades, ResumenVenta.ingresos)
+                 .filter(*condiciones, ResumenVenta.clave_id == 0)
+                 .order_by(ResumenVenta.periodo)
+                 .all())
+        formato = "%Y-%m-%d" if granularidad == "dia" else "%Y-%m"
+        return jsonify({
+            "granularidad": granularidad,
+            "dimension": dimension,
+            "labels": [f.periodo.strftime(formato) for f in filas],
+            "pedidos": [f.pedidos for f in filas],
+            "unidades": [f.unidades for f in filas],
+            "ingresos": [float(f.ingresos) for f in filas],
+        })
+
+    # Por producto o categoría: ranking de los que más facturaron en el rango
+    ingresos = db.func.sum(ResumenVenta.ingresos)
+    filas = (db.session.query(ResumenVenta.clave_id, db.func.sum(ResumenVenta.unidades), ingresos)
+             .filter(*condiciones, ResumenVenta.pedidos > 0)
+             .group_by(ResumenVenta.clave_id)
+             .order_by(ingresos.desc())
+             .limit(request.args.get("limite", 10, type=int))
+             .all())
+    modelo = Producto if dimension == "producto" else Categoria
+    ids = [f[0] for f in filas]
+    nombres = dict(db.session.query(modelo.id, modelo.nombre).filter(modelo.id.in_(ids)).all())
+    return jsonify({
+        "granularidad": granularidad,
+        "dimension": dimension,
+        "labels": [nombres.get(f[0], "Sin categoría") for f in filas],
+        "unidades": [int(f[1]) for f in filas],
+        "ingresos": [float(f[2]) for f in filas],
+    })
+
+# ============================
+# PEDIDOS (ADMIN)
+# ============================
+
+# Cantidad de pedidos por página en el panel
+PEDIDOS_POR_PAGINA = 50
+
+ESTADOS_PEDIDO = ('pendiente', 'pagado', 'enviado', 'cancelado')
+
+def leer_fecha(texto):
+    try:
+        return datetime.strptime(texto, "%Y-%m-%d")
+    except (ValueError, TypeError):
+        return None
+
+def filtros_pedidos():
+    # Lee los filtros del listado de pedidos desde la URL
+    return {
+        "estado": request.args.get("estado", ""),
+        "desde": request.args.get("desde", ""),
+        "hasta": request.args.get("hasta", ""),
+        "cliente": request.args.get("cliente", "").strip(),
+    }
+
+def condiciones_pedidos(filtros):
+    condiciones = []
+    if filtros["estado"]:
+        condiciones.append(Pedido.estado == filtros["estado"])
+    desde = leer_fecha(filtros["desde"])
+    if desde:
+        condiciones.append(Pedido.fecha >= desde)
+    hasta = leer_fecha(filtros["hasta"])
+    if hasta:
+        # "hasta" incluye todo ese día
+        condiciones.append(Pedido.fecha < hasta + timedelta(days=1))
+    if filtros["cliente"]:
+        patron = f"%{filtros['cliente']}%"
+        condiciones.append(Pedido.usuario_id.in_(
+            db.select(Usuario.id).where(db.or_(Usuario.nombre.like(patron), Usuario.email.like(patron)))
+        ))
+    return condiciones
+
+@tienda.route("/admin/pedidos")
+@solo_lectura
 @admin_required
 def admin_pedidos():
-    pedidos = Pedido.query.order_by(Pedido.fecha.desc()).all()
-    return render_template("admin_pedidos.html", pedidos=pedidos, section="pedidos")
+    filtros = filtros_pedidos()
+    pagina = request.args.get("pagina", 1, type=int)
+    # Cargamos usuario, items y productos de antemano: la cantidad de consultas
+    # no depende de cuántos pedidos haya en la página.
+    query = (Pedido.query
+             .filter(*condiciones_pedidos(filtros))
+             .options(joinedload(Pedido.usuario),
+                      selectinload(Pedido.items).joinedload(DetallePedido.producto))
+             .order_by(Pedido.fecha.desc(), Pedido.id.desc()))
+    pedidos = query.paginate(page=pagina, per_page=PEDIDOS_POR_PAGINA, error_out=False)
+    filtros_url = {k: v for k, v in filtros.items() if v}
+    return render_template("admin_pedidos.html", pedidos=pedidos.items, paginacion=pedidos,
+                           filtros=filtros, filtros_url=filtros_url, section="pedidos")
+
+@tienda.route("/admin/pedidos/<int:id>/estado", methods=["POST"])
+@admin_required
+def admin_estado_pedido(id):
+    pedido = Pedido.query.get_or_404(id)
+    nuevo = request.form.get("estado")
+    if nuevo in ESTADOS_PEDIDO and nuevo != pedido.estado:
+        # Cancelar descuenta el pedido de los reportes; reactivarlo lo vuelve a sumar
+        if (pedido.estado == 'cancelado') != (nuevo == 'cancelado'):
+            encolar("resumen_venta", {"pedido_id": pedido.id, "signo": -1 if nuevo == 'cancelado' else 1})
+        pedido.estado = nuevo
+        db.session.commit()
+    return redirect(request.referrer or url_for('tienda.admin_pedidos'))
+
+@tienda.route("/admin/pedidos/exportar")
+@solo_lectura
+@admin_required
+def admin_exportar_pedidos():
+    formato = request.args.get("formato", "csv")
+    consulta = (db.select(Pedido.id, Pedido.fecha, Pedido.estado, Pedido.total,
+                          Usuario.nombre, Usuario.email,
+                          DetallePedido.producto_id, Producto.nombre,
+                          DetallePedido.cantidad, DetallePedido.precio_unitario)
+                .join(Usuario, Pedido.usuario_id == Usuario.id)
+                .join(DetallePedido, DetallePedido.pedido_id == Pedido.id)
+                .join(Producto, DetallePedido.producto_id == Producto.id)
+                .where(*condiciones_pedidos(filtros_pedidos()))
+                .order_by(Pedido.id, DetallePedido.id)
+                .execution_options(yield_per=1000))
+
+    # Se lee de a lotes y se va enviando: nunca se arma el resultado completo en memoria
+    def filas():
+        return db.session.execute(consulta)
+
+    def generar_csv():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(["pedido_id", "fecha", "estado", "total", "cliente", "email",
+                           "producto_id", "producto", "cantidad", "precio_unitario"])
+        for fila in filas():
+            escritor.writerow(fila)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def generar_ndjson():
+        # Las filas vienen ordenadas por pedido: agrupamos sus items consecutivos
+        for pedido_id, grupo in groupby(filas(), key=lambda fila: fila[0]):
+            grupo = list(grupo)
+            primera = grupo[0]
+            pedido = {
+                "id": pedido_id,
+                "fecha": primera[1].isoformat() if primera[1] else None,
+                "estado": primera[2],
+                "total": float(primera[3]),
+                "cliente": primera[4],
+                "email": primera[5],
+                "items": [{"producto_id": f[6], "producto": f[7], "cantidad": f[8],
+                           "precio_unitario": float(f[9])} for f in grupo],
+            }
+            yield json.dumps(pedido, ensure_ascii=False) + "\n"
+
+    if formato == "ndjson":
+        return Response(stream_with_context(generar_ndjson()), mimetype="application/x-ndjson",
+                        headers={"Content-Disposition": "attachment; filename=pedidos.ndjson"})
+    return Response(stream_with_context(generar_csv()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=pedidos.csv"})
 
 # ============================
 # FINALIZAR COMPRA
 # ============================
 
-@app.route("/finalizar_compra", methods=["POST"])
-@login_required
-def finalizar_compra():
-    carrito = session.get("carrito", [])
-    if not carrito:
-        return redirect(url_for("carrito"))
-    total = sum(item["precio"] * item.get("cantidad", 1) for item in carrito)
-    insuficientes = []
-    for item in carrito:
-        prod = Producto.query.get(item["id"])
-        cantidad = item.get("cantidad", 1)
-        if not prod or prod.stock < cantidad:
-            insuficientes.append((prod.nombre if prod else f"ID {item['id']}", prod.stock if prod else 0, cantidad))
-    if insuficientes:
-        mensaje = "Stock insuficiente para: " + ", ".join([f"{n} (stock {s}, pedido {c})" for n, s, c in insuficientes])
-        total = sum(item["precio"] * item.get("cantidad", 1) for item in carrito)
-        return render_template("carrito.html", items=carrito, total=total, error=mensaje)
-    nuevo_pedido = Pedido(usuario_id=session["usuario_id"], total=total)
+# Reintentos ante bloqueos o deadlocks de la base al confirmar una compra
+CHECKOUT_REINTENTOS = 3
+
+class StockInsuficiente(Exception):
+    def __init__(self, faltantes):
+        super().__init__("Stock insuficiente")
+        self.faltantes = faltantes
+
+class ConflictoDeStock(Exception):
+    """Otro pedido tomó el stock entre la lectura y la reserva."""
+
+def intentar_pedido(usuario_id, cantidades):
+    ids = sorted(cantidades)
+    # Una sola consulta para todos los productos del carrito
+    productos = {p.id: p for p in Producto.query.filter(Producto.id.in_(ids)).all()}
+    faltantes = []
+    for producto_id in ids:
+        prod = productos.get(producto_id)
+        if not prod or prod.stock < cantidades[producto_id]:
+            faltantes.append((prod.nombre if prod else f"ID {producto_id}",
+                              prod.stock if prod else 0, cantidades[producto_id]))
+    if faltantes:
+        raise StockInsuficiente(faltantes)
+
+    # Reserva de stock en un único UPDATE condicional: solo descuenta si
+    # alcanza, así dos compras simultáneas no pueden vender de más. Los
+    # bloqueos de fila se toman en orden de id, lo que evita deadlocks.
+    descuento = db.case(cantidades, value=Producto.id)
+    resultado = db.session.execute(
+        db.update(Producto)
+        .where(Producto.id.in_(ids), Producto.stock >= descuento)
+        .values(stock=Producto.stock - descuento)
+        .execution_options(synchronize_session=False)
+    )
+    if resultado.rowcount != len(ids):
+        raise ConflictoDeStock()
+
+    # Los precios salen de la base, no de la sesión del navegador
+    total = sum(productos[i].precio * cantidades[i] for i in ids)
+    nuevo_pedido = Pedido(usuario_id=usuario_id, total=total, fecha=datetime.now())
     db.session.add(nuevo_pedido)
     db.session.flush()
-    for item in carrito:
-        cantidad = item.get("cantidad", 1)
-        pedido_item = DetallePedido(
-            pedido_id=nuevo_pedido.id,
-            producto_id=item["id"],
-            cantidad=cantidad,
-            precio_unitario=item["precio"]
-        )
-        db.session.add(pedido_item)
-        prod = Producto.query.get(item["id"])
-        if prod:
-            prod.stock = prod.stock - cantidad
+    db.session.execute(db.insert(DetallePedido), [
+        {"pedido_id": nuevo_pedido.id, "producto_id": i,
+         "cantidad": cantidades[i], "precio_unitario": productos[i].precio}
+        for i in ids
+    ])
+    encolar("resumen_venta", {"pedido_id": nuevo_pedido.id, "signo": 1}, clave=f"resumen_venta:{nuevo_pedido.id}")
+    encolar("stock_bajo", {"productos": ids}, clave=f"stock_bajo:{nuevo_pedido.id}")
     db.session.commit()
-    session["carrito"] = []
-    return redirect(url_for("pedido_confirmado", id=nuevo_pedido.id))
+    return nuevo_pedido.id
+
+def crear_pedido(usuario_id, cantidades):
+    for intento in range(CHECKOUT_REINTENTOS + 1):
+        try:
+            return intentar_pedido(usuario_id, cantidades)
+        except StockInsuficiente:
+            db.session.rollback()
+            raise
+        except (ConflictoDeStock, OperationalError):
+            db.session.rollback()
+            if intento == CHECKOUT_REINTENTOS:
+                raise
+            time.sleep(0.05 * 2 ** intento)
 
-@app.route("/pedido/<int:id>/confirmado")
+@tienda.route("/finalizar_compra", methods=["POST"])
+@login_required
+def finalizar_compra():
+    carrito_id = carrito_actual()
+    cantidades = carritos.items(carrito_id)
+    if not cantidades:
+        return redirect(url_for("tienda.carrito"))
+    try:
+        pedido_id = crear_pedido(session["usuario_id"], cantidades)
+    except StockInsuficiente as e:
+        mensaje = "Stock insuficiente para: " + ", ".join([f"{n} (stock {s}, pedido {c})" for n, s, c in e.faltantes])
+        items, total = armar_carrito(cantidades)
+        return render_template("carrito.html", items=items, total=total, error=mensaje)
+    # El stock no afecta a los listados, solo a las filas de esos productos
+    invalidar_productos(*cantidades, listados=False)
+    carritos.vaciar(carrito_id)
+    return redirect(url_for("tienda.pedido_confirmado", id=pedido_id))
+
+@tienda.route("/pedido/<int:id>/confirmado")
 @login_required
 def pedido_confirmado(id):
     pedido = Pedido.query.get_or_404(id)
     return render_template("pedido_confirmado.html", pedido=pedido)
 
+# ============================
+# AUTENTICACIÓN
+# ============================
+
+class HashesSaturados(Exception):
+    """Hay demasiadas contraseñas esperando su hash: el request se rechaza."""
+
+# Calcular un hash es CPU pura: en otro proceso no frena a los demás requests
+# del worker. El semáforo limita cuántos pueden estar esperando a la vez.
+lugares_hash = de_la_app("lugares_hash")
+lock_hashes = threading.Lock()
+
+def ejecutar_hash(funcion, *args):
+    if not current_app.config['HASH_PROCESOS']:
+        return funcion(*args)
+    if not lugares_hash.acquire(blocking=False):
+        raise HashesSaturados()
+    try:
+        estado = current_app.extensions["tienda"]
+        with lock_hashes:
+            # Se crea recién al primer uso: los comandos de flask no lo necesitan
+            if estado["procesador_hashes"] is None:
+                # forkserver: hacer fork desde un worker con hilos podría copiar
+                # un lock tomado por otro hilo (logging, pool de conexiones)
+                estado["procesador_hashes"] = ProcessPoolExecutor(
+                    max_workers=current_app.config['HASH_PROCESOS'],
+                    mp_context=multiprocessing.get_context("forkserver"))
+        return estado["procesador_hashes"].submit(funcion, *args).result()
+    finally:
+        lugares_hash.release()
+
+def hashear_password(password):
+    return ejecutar_hash(generate_password_hash, password, current_app.config['HASH_METODO'])
+
+def verificar_password(password_hash, password):
+    return ejecutar_hash(check_password_hash, password_hash, password)
+
+prefijos_hash = {}
+
+def necesita_rehash(password_hash):
+    # "scrypt:32768:8:1$sal$hash": si el método o sus parámetros cambiaron
+    # desde que se guardó, hay que volver a calcularlo
+    metodo = current_app.config['HASH_METODO']
+    if metodo not in prefijos_hash:
+        prefijos_hash[metodo] = generate_password_hash("", metodo).split("$", 1)[0]
+    return password_hash.split("$", 1)[0] != prefijos_hash[metodo]
+
+def buscar_usuario_por_email(email):
+    # Solo las columnas del login, por el índice único de email
+    return db.session.execute(
+        db.select(Usuario.id, Usuario.nombre, Usuario.rol, Usuario.password_hash)
+        .where(Usuario.email == email)
+    ).first()
+
+def rol_de_usuario(usuario_id):
+    """Rol actual del usuario, o None si ya no existe.
+
+    Se cachea con una versión por usuario que se incrementa al editarlo o
+    eliminarlo; como las versiones son compartidas, el cambio vale enseguida
+    en todos los procesos.
+    """
+    clave = f"rol:{usuario_id}:{cache.version(f'usuario:{usuario_id}:version')}"
+    cacheado = cache.get(clave)
+    if cacheado is None:
+        # Siempre del primario: una réplica atrasada podría devolver el rol
+        # anterior a un cambio y quedaría cacheado con la versión nueva
+        rol = db.session.execute(db.select(Usuario.rol).where(Usuario.id == usuario_id),
+                                 bind_arguments={"bind": db.engine}).scalar()
+        cacheado = {"rol": rol}
+        cache.set(clave, cacheado, ttl=current_app.config['ROLES_TTL'])
+    return cacheado["rol"]
+
+def invalidar_usuario(usuario_id):
+    cache.incr(f"usuario:{usuario_id}:version")
+
+@tienda.app_errorhandler(HashesSaturados)
+def hashes_saturados(error):
+    plantilla = "register.html" if request.endpoint == "tienda.register_post" else "login.html"
+    respuesta = make_response(render_template(plantilla, error="Hay muchos ingresos en este momento, probá de nuevo en unos segundos"), 503)
+    respuesta.headers["Retry-After"] = "5"
+    return respuesta
+
 # ============================
 # LOGIN / LOGOUT / REGISTER
 # ============================
 
-@app.route("/login", methods=["GET", "POST"])
+@tienda.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "GET":
         return render_template("login.html")
     email = request.form["email"]
     password = request.form["password"]
-    usuario = Usuario.query.filter_by(email=email).first()
-    if not usuario or not check_password_hash(usuario.password_hash, password):
+    usuario = buscar_usuario_por_email(email)
+    if not usuario or not verificar_password(usuario.password_hash, password):
         return render_template("login.html", error="Email o contraseña incorrectos")
+    if necesita_rehash(usuario.password_hash):
+        # Es el único momento en que tenemos la contraseña: se aprovecha para
+        # guardarla con el método actual
+        db.session.execute(db.update(Usuario).where(Usuario.id == usuario.id)
+                           .values(password_hash=hashear_password(password)))
+        db.session.commit()
     session["usuario_id"] = usuario.id
     session["usuario_nombre"] = usuario.nombre
     session["usuario_rol"] = usuario.rol  # <--- Guardamos rol
     return redirect("/")
 
-@app.route('/logout')
+@tienda.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('index'))
+    return redirect(url_for('tienda.index'))
 
-@app.route("/register")
+@tienda.route("/register")
 def register():
     return render_template("register.html", active="register")
 
-@app.route("/register", methods=["POST"])
+@tienda.route("/register", methods=["POST"])
 def register_post():
     nombre = request.form["nombre"]
     email = request.form["email"]
@@ -384,24 +2532,62 @@ def register_post():
     password2 = request.form["password2"]
     if password != password2:
         return render_template("register.html", error="Las contraseñas no coinciden")
-    existe = Usuario.query.filter_by(email=email).first()
+    existe = buscar_usuario_por_email(email)
     if existe:
         return render_template("register.html", error="El email ya está registrado")
     nuevo = Usuario(
         nombre=nombre,
         email=email,
-        password_hash=generate_password_hash(password),
+        password_hash=hashear_password(password),
         rol="cliente"
     )
     db.session.add(nuevo)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otro registro con el mismo email se guardó mientras se calculaba el hash
+        db.session.rollback()
+        return render_template("register.html", error="El email ya está registrado")
     return redirect("/login")
 
+# ============================
+# APLICACIÓN
+# ============================
+
+def create_app(config=None):
+    """Arma la aplicación: configuración del entorno, pisada por `config` si se pasa.
+
+    Cada aplicación tiene su propia caché, carritos, métricas y pools, así
+    que se pueden crear varias en el mismo proceso (por ejemplo una por base).
+    """
+    app = Flask(__name__)
+    configurar(app)
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', opciones_pool(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    db.init_app(app)
+    app.register_blueprint(tienda)
+    app.jinja_env.bytecode_cache = crear_cache_bytecode(app.config['JINJA_CACHE_CARPETA'])
+    app.extensions["tienda"] = {
+        "cache": crear_cache(app.config),
+        "carritos": crear_carritos(app.config),
+        "metricas": Metricas(),
+        "procesador_imagenes": ThreadPoolExecutor(max_workers=app.config['IMAGENES_WORKERS']),
+        "variantes_listas": set(),
+        "lugares_hash": threading.BoundedSemaphore(app.config['HASH_COLA_MAXIMA']),
+        "procesador_hashes": None,
+    }
+    if app.config['METRICAS']:
+        registrar_metricas(app)
+    return app
+
 # ============================
 # INICIAR SERVIDOR
 # ============================
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         db.create_all()
     app.run(debug=True)
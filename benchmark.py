@@ -0,0 +1,455 @@
+"""Mide latencia y throughput de las rutas principales con varios workers a la vez.
+
+Primero hay que cargar datos con generar_datos.py. El script lee los rangos
+de ids de la base, así que DATABASE_URL tiene que apuntar a la misma base que
+usa el servidor. Ejemplos:
+
+    # Con el cliente de prueba de Flask, en el mismo proceso
+    DATABASE_URL=sqlite:///tienda_bench.db python benchmark.py --requests 500 --workers 8
+
+    # Contra un servidor ya levantado
+    DATABASE_URL=sqlite:///tienda_bench.db python benchmark.py --url http://localhost:8000 --rutas index producto
+
+    # Muchos workers comprando el mismo producto con 50 unidades: no se tiene que vender de más
+    DATABASE_URL=sqlite:///tienda_bench.db python benchmark.py --rutas --sobreventa 50 --workers 16
+
+    # Bytes y tiempo de la primera visita contra las siguientes (ETag + compresión)
+    DATABASE_URL=sqlite:///tienda_bench.db python benchmark.py --rutas --visitas-repetidas
+
+    # La misma medición con catálogos de 1k, 100k y 1M productos (la latencia no debería crecer)
+    python benchmark.py --escalas 1000 100000 1000000
+
+    # Solo el render de una grilla de 1000 tarjetas, con y sin caché de fragmentos
+    DATABASE_URL=sqlite:///tienda_bench.db python benchmark.py --rutas --render 1000
+
+Los resultados se guardan en benchmarks/<commit>.json; con --comparar se
+muestra la diferencia contra una corrida anterior.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+CLAVE = "clave123"
+# Palabras que usa generar_datos.py en los nombres de productos
+BUSQUEDAS = ("cuaderno", "mochila azul", "lapicera", "remera escolar", "marcador")
+
+
+class ClienteFlask:
+    """Usa el test client de Flask: mide la aplicación sin red de por medio."""
+
+    def __init__(self, app):
+        self.cliente = app.test_client()
+
+    def get(self, url):
+        return self.cliente.get(url).status_code
+
+    def post(self, url, datos=None):
+        return self.cliente.post(url, data=datos or {}).status_code
+
+
+class ClienteHTTP:
+    """Habla HTTP contra un servidor real, con sus propias cookies."""
+
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        self.abridor = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), SinRedirecciones())
+
+    def pedir(self, url, datos=None):
+        cuerpo = urllib.parse.urlencode(datos).encode() if datos is not None else None
+        try:
+            with self.abridor.open(self.base + url, data=cuerpo) as respuesta:
+                respuesta.read()
+                return respuesta.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    def get(self, url):
+        return self.pedir(url)
+
+    def post(self, url, datos=None):
+        return self.pedir(url, datos or {})
+
+
+class SinRedirecciones(urllib.request.HTTPRedirectHandler):
+    # Medimos cada request por separado, sin seguir los redirect
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def datos_de_prueba(app):
+    # Rangos de ids y un email de cliente para armar los requests
+    from app import db, Producto, Usuario
+    with app.app_context():
+        productos = db.session.query(db.func.min(Producto.id), db.func.max(Producto.id)).one()
+        cliente = Usuario.query.filter_by(rol="cliente").first()
+    return {"productos": productos, "cliente": cliente.email if cliente else None}
+
+
+def iniciar_sesion(cliente, email):
+    cliente.post("/login", {"email": email, "password": CLAVE})
+
+
+# Cada escenario tiene una preparación (no se mide) y el request que se mide
+def sin_preparacion(cliente, datos):
+    pass
+
+
+def medir_index(cliente, datos):
+    orden = random.choice(["", "mayor", "menor", "antiguo"])
+    return cliente.get(f"/?orden={orden}&precio={random.randint(1000, 50000)}")
+
+
+def medir_index_profundo(cliente, datos):
+    # Una página cualquiera del catálogo, como si se hubiera llegado con "Ver más"
+    return cliente.get(f"/?despues={random.randint(*datos['productos'])}")
+
+
+def medir_busqueda(cliente, datos):
+    return cliente.get(f"/?q={random.choice(BUSQUEDAS)}&despues={random.randint(*datos['productos'])}")
+
+
+def medir_producto(cliente, datos):
+    return cliente.get(f"/producto/{random.randint(*datos['productos'])}")
+
+
+def preparar_cliente(cliente, datos):
+    iniciar_sesion(cliente, datos["cliente"])
+
+
+def medir_finalizar_compra(cliente, datos):
+    cliente.post(f"/agregar_carrito/{random.randint(*datos['productos'])}", {"cantidad": 1})
+    return cliente.post("/finalizar_compra")
+
+
+def preparar_admin(cliente, datos):
+    iniciar_sesion(cliente, "admin@ejemplo.com")
+
+
+def medir_admin_pedidos(cliente, datos):
+    return cliente.get(f"/admin/pedidos?pagina={random.randint(1, 20)}")
+
+
+def medir_login(cliente, datos):
+    return cliente.post("/login", {"email": datos["cliente"], "password": CLAVE})
+
+
+ESCENARIOS = {
+    "index": (sin_preparacion, medir_index),
+    "index_profundo": (sin_preparacion, medir_index_profundo),
+    "busqueda": (sin_preparacion, medir_busqueda),
+    "producto": (sin_preparacion, medir_producto),
+    "finalizar_compra": (preparar_cliente, medir_finalizar_compra),
+    "admin_pedidos": (preparar_admin, medir_admin_pedidos),
+    "login": (sin_preparacion, medir_login),
+}
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def correr_escenario(nombre, args, datos, app):
+    preparar, medir = ESCENARIOS[nombre]
+    tiempos, errores = [], []
+    lock = threading.Lock()
+    por_worker = max(1, args.requests // args.workers)
+
+    def worker():
+        cliente = ClienteHTTP(args.url) if args.url else ClienteFlask(app)
+        preparar(cliente, datos)
+        propios, fallidos = [], 0
+        for _ in range(por_worker):
+            inicio = time.perf_counter()
+            estado = medir(cliente, datos)
+            propios.append(time.perf_counter() - inicio)
+            if estado >= 400:
+                fallidos += 1
+        with lock:
+            tiempos.extend(propios)
+            errores.append(fallidos)
+
+    hilos = [threading.Thread(target=worker) for _ in range(args.workers)]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+    return {
+        "requests": len(tiempos),
+        "errores": sum(errores),
+        "p50_ms": round(percentil(tiempos, 0.50) * 1000, 2),
+        "p95_ms": round(percentil(tiempos, 0.95) * 1000, 2),
+        "p99_ms": round(percentil(tiempos, 0.99) * 1000, 2),
+        "requests_por_segundo": round(len(tiempos) / duracion, 1),
+    }
+
+
+def medir_sobreventa(args, datos, stock, app):
+    """Todos los workers compran de a una unidad el mismo producto hasta agotarlo.
+
+    Al final se revisa en la base que el stock no quedó negativo y que las
+    unidades de los pedidos confirmados son exactamente las que se descontaron.
+    """
+    from app import db, Producto, Pedido, DetallePedido, invalidar_productos
+    producto_id = datos["productos"][0]
+    with app.app_context():
+        db.session.execute(db.update(Producto).where(Producto.id == producto_id).values(stock=stock))
+        db.session.commit()
+        invalidar_productos(producto_id)
+        ultimo_pedido = db.session.query(db.func.max(Pedido.id)).scalar() or 0
+
+    confirmados, errores = [], []
+    lock = threading.Lock()
+
+    def worker():
+        cliente = ClienteHTTP(args.url) if args.url else ClienteFlask(app)
+        iniciar_sesion(cliente, datos["cliente"])
+        propios, fallidos = 0, 0
+        while True:
+            cliente.post(f"/agregar_carrito/{producto_id}", {"cantidad": 1})
+            estado = cliente.post("/finalizar_compra")
+            if estado == 302:
+                propios += 1
+                continue
+            # 200 es el carrito con "stock insuficiente": se terminó el producto
+            if estado >= 400:
+                fallidos += 1
+            break
+        with lock:
+            confirmados.append(propios)
+            errores.append(fallidos)
+
+    hilos = [threading.Thread(target=worker) for _ in range(args.workers)]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+
+    with app.app_context():
+        final = db.session.query(Producto.stock).filter_by(id=producto_id).scalar()
+        detalle = (db.session.query(db.func.count(db.distinct(DetallePedido.pedido_id)),
+                                    db.func.coalesce(db.func.sum(DetallePedido.cantidad), 0))
+                   .filter(DetallePedido.producto_id == producto_id, DetallePedido.pedido_id > ultimo_pedido)
+                   .one())
+    pedidos, vendidas = detalle
+    return {
+        "stock_inicial": stock,
+        "stock_final": final,
+        "pedidos": pedidos,
+        "unidades_vendidas": int(vendidas),
+        "confirmados_por_clientes": sum(confirmados),
+        "errores": sum(errores),
+        "pedidos_por_segundo": round(pedidos / duracion, 1),
+        "ok": final >= 0 and stock - final == vendidas and pedidos == sum(confirmados),
+    }
+
+
+def pedir_pagina(args, cliente_flask, url, cabeceras):
+    # Devuelve (estado, bytes recibidos, ETag, segundos); los bytes son los que
+    # viajan, comprimidos si la respuesta vino comprimida
+    inicio = time.perf_counter()
+    if args.url:
+        pedido = urllib.request.Request(args.url.rstrip("/") + url, headers=cabeceras)
+        try:
+            with urllib.request.urlopen(pedido) as respuesta:
+                cuerpo, estado, etag = respuesta.read(), respuesta.status, respuesta.headers.get("ETag")
+        except urllib.error.HTTPError as error:
+            cuerpo, estado, etag = error.read(), error.code, error.headers.get("ETag")
+    else:
+        respuesta = cliente_flask.get(url, headers=cabeceras)
+        cuerpo, estado, etag = respuesta.data, respuesta.status_code, respuesta.headers.get("ETag")
+    return estado, len(cuerpo), etag, time.perf_counter() - inicio
+
+
+def medir_visitas_repetidas(args, datos, app, repeticiones=50):
+    """Compara la primera visita a una página con las siguientes.
+
+    La primera se pide sin compresión ni ETag, como un navegador sin caché;
+    las siguientes mandan If-None-Match y Accept-Encoding, y deberían volver
+    como 304 sin cuerpo.
+    """
+    cliente_flask = None if args.url else ClienteFlask(app).cliente
+    resultado = {}
+    for url in ("/", "/?orden=menor", f"/producto/{datos['productos'][0]}"):
+        estado, tamanio, etag, duracion = pedir_pagina(args, cliente_flask, url, {})
+        repetidas = [pedir_pagina(args, cliente_flask, url, {"If-None-Match": etag or "", "Accept-Encoding": "gzip, br"})
+                     for _ in range(repeticiones)]
+        resultado[url] = {
+            "primera_bytes": tamanio,
+            "primera_ms": round(duracion * 1000, 2),
+            "repetida_bytes": round(sum(r[1] for r in repetidas) / len(repetidas)),
+            "repetida_p50_ms": round(percentil([r[3] for r in repetidas], 0.50) * 1000, 2),
+            "repetidas_304": sum(1 for r in repetidas if r[0] == 304),
+        }
+    return resultado
+
+
+def medir_render(app, cantidad, repeticiones=10):
+    """Compara el render de la grilla y la carga de plantillas con y sin caché."""
+    from app import db, Producto, obtener_productos
+    resultado = {}
+    with app.test_request_context("/"):
+        ids = [i for (i,) in db.session.query(Producto.id).order_by(Producto.id).limit(cantidad)]
+        productos = obtener_productos(ids)
+        resultado["tarjetas"] = len(productos)
+        grilla = app.jinja_env.get_template("grilla_productos.html")
+        activa = app.config["FRAGMENTOS"]
+        for nombre, fragmentos in (("sin_fragmentos", False), ("con_fragmentos", True)):
+            app.config["FRAGMENTOS"] = fragmentos
+            grilla.render(productos=productos)  # la primera vez llena la caché
+            tiempos = []
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                grilla.render(productos=productos)
+                tiempos.append(time.perf_counter() - inicio)
+            resultado[f"render_{nombre}_ms"] = round(percentil(tiempos, 0.50) * 1000, 2)
+        app.config["FRAGMENTOS"] = activa
+
+    # Lo que tarda un worker nuevo en cargar todas las plantillas
+    for nombre, bytecode in (("sin_bytecode", None), ("con_bytecode", app.jinja_env.bytecode_cache)):
+        entorno = app.jinja_env.overlay(bytecode_cache=bytecode, cache_size=0)
+        inicio = time.perf_counter()
+        for plantilla in app.jinja_env.list_templates():
+            entorno.get_template(plantilla)
+        resultado[f"carga_plantillas_{nombre}_ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+    return resultado
+
+
+def medir_escalas(args):
+    """Corre las rutas del catálogo contra una base por cada cantidad de productos.
+
+    Cada base se genera una sola vez con generar_datos.py y se vuelve a usar
+    en las corridas siguientes. Todas se miden en este proceso, con una
+    aplicación por base.
+    """
+    from app import create_app, db
+    from generar_datos import generar
+    rutas = args.rutas if args.rutas is not None else ["index", "index_profundo", "busqueda", "producto"]
+    resultados = {}
+    for cantidad in args.escalas:
+        app = create_app({"SQLALCHEMY_DATABASE_URI": args.base_escala.format(n=cantidad)})
+        marca = os.path.join("benchmarks", f"escala_{cantidad}.generada")
+        os.makedirs("benchmarks", exist_ok=True)
+        if not os.path.exists(marca):
+            print(f"Generando {cantidad} productos...")
+            with app.app_context():
+                generar(productos=cantidad, usuarios=100, pedidos=100, resumenes=False)
+            open(marca, "w").close()
+        datos = datos_de_prueba(app)
+        resultados[cantidad] = {ruta: correr_escenario(ruta, args, datos, app) for ruta in rutas}
+        with open(os.path.join("benchmarks", f"escala_{cantidad}.json"), "w") as archivo:
+            json.dump({"commit": commit_actual(), "rutas": resultados[cantidad]}, archivo, indent=2)
+        with app.app_context():
+            db.engine.dispose()
+
+    print(f"\n{'ruta':18} {'productos':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for ruta in rutas:
+        for cantidad in args.escalas:
+            r = resultados[cantidad][ruta]
+            print(f"{ruta:18} {cantidad:>10} {r['p50_ms']:>10} {r['p95_ms']:>10}")
+        menor, mayor = resultados[args.escalas[0]][ruta], resultados[args.escalas[-1]][ruta]
+        if menor["p95_ms"]:
+            print(f"{ruta:18} p95 x{mayor['p95_ms'] / menor['p95_ms']:.2f} de {args.escalas[0]} a {args.escalas[-1]}")
+    return resultados
+
+
+def commit_actual():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "sin-git"
+
+
+def comparar(actual, anterior):
+    print(f"\nComparación contra {anterior['commit']} ({anterior['fecha']}):")
+    for ruta, resultado in actual["rutas"].items():
+        previo = anterior["rutas"].get(ruta)
+        if not previo:
+            continue
+        for campo in ("p50_ms", "p95_ms", "p99_ms", "requests_por_segundo"):
+            cambio = (resultado[campo] - previo[campo]) / previo[campo] * 100 if previo[campo] else 0
+            print(f"  {ruta:18} {campo:22} {previo[campo]:>10} -> {resultado[campo]:>10} ({cambio:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rutas", nargs="*", choices=sorted(ESCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="requests por ruta")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--url", help="servidor a medir; si no se indica se usa el test client")
+    parser.add_argument("--escalas", type=int, nargs="+", metavar="PRODUCTOS",
+                        help="comparar las rutas del catálogo con bases de distintos tamaños")
+    parser.add_argument("--base-escala", default="sqlite:///" + os.path.abspath(os.path.join("benchmarks", "escala_{n}.db")),
+                        help="URL de la base de cada tamaño; {n} es la cantidad de productos")
+    parser.add_argument("--sobreventa", type=int, metavar="STOCK",
+                        help="comprar entre todos los workers un producto con ese stock y verificar que no se venda de más")
+    parser.add_argument("--visitas-repetidas", action="store_true",
+                        help="comparar bytes y tiempo de la primera visita con las siguientes")
+    parser.add_argument("--render", type=int, metavar="TARJETAS", help="medir también el render de una grilla")
+    parser.add_argument("--salida", help="archivo de resultados (por defecto benchmarks/<commit>.json)")
+    parser.add_argument("--comparar", help="resultados anteriores para comparar")
+    args = parser.parse_args()
+
+    if args.escalas:
+        medir_escalas(args)
+        return
+
+    if args.rutas is None:
+        args.rutas = sorted(ESCENARIOS)
+    from app import create_app
+    app = create_app()
+    datos = datos_de_prueba(app)
+    resultado = {"commit": commit_actual(), "fecha": datetime.now().isoformat(timespec="seconds"),
+                 "modo": "http" if args.url else "test_client", "workers": args.workers, "rutas": {}}
+    for ruta in args.rutas:
+        resultado["rutas"][ruta] = correr_escenario(ruta, args, datos, app)
+        r = resultado["rutas"][ruta]
+        print(f"{ruta:18} {r['requests']:>6} req  p50 {r['p50_ms']:>8} ms  p95 {r['p95_ms']:>8} ms  "
+              f"p99 {r['p99_ms']:>8} ms  {r['requests_por_segundo']:>8} req/s  errores {r['errores']}")
+    if args.sobreventa:
+        resultado["sobreventa"] = medir_sobreventa(args, datos, args.sobreventa, app)
+        for campo, valor in resultado["sobreventa"].items():
+            print(f"{campo:40} {valor!s:>10}")
+    if args.visitas_repetidas:
+        resultado["visitas_repetidas"] = medir_visitas_repetidas(args, datos, app)
+        for url, r in resultado["visitas_repetidas"].items():
+            print(f"{url:22} primera {r['primera_bytes']:>8} B {r['primera_ms']:>8} ms  "
+                  f"repetida {r['repetida_bytes']:>8} B {r['repetida_p50_ms']:>8} ms  304: {r['repetidas_304']}")
+    if args.render:
+        resultado["render"] = medir_render(app, args.render)
+        for campo, valor in resultado["render"].items():
+            print(f"{campo:40} {valor:>10}")
+
+    salida = args.salida or os.path.join("benchmarks", f"{resultado['commit']}.json")
+    os.makedirs(os.path.dirname(salida) or ".", exist_ok=True)
+    with open(salida, "w") as archivo:
+        json.dump(resultado, archivo, indent=2)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar) as archivo:
+            comparar(resultado, json.load(archivo))
+
+    if args.sobreventa and not resultado["sobreventa"]["ok"]:
+        raise SystemExit("Se vendió de más o no coinciden los pedidos con el stock descontado")
+
+
+if __name__ == "__main__":
+    main()
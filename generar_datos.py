@@ -0,0 +1,137 @@
+"""Genera datos de prueba en cantidad para medir la tienda a escala.
+
+Ejemplo, contra un SQLite local:
+
+    DATABASE_URL=sqlite:///tienda_bench.db python generar_datos.py --productos 100000 --pedidos 200000
+
+Todos los usuarios generados tienen la contraseña "clave123" y el admin es
+admin@ejemplo.com. Los inserts se hacen en lotes para que escale a millones de filas.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db, Categoria, Producto, Usuario, Pedido, DetallePedido, reconstruir_resumen_ventas
+
+CLAVE = "clave123"
+ESTADOS = ('pendiente', 'pagado', 'enviado', 'cancelado')
+PALABRAS = ("Lapicera", "Lápiz", "Cuaderno", "Carpeta", "Cartuchera", "Remera", "Buzo", "Mochila",
+            "Botella", "Regla", "Goma", "Marcador", "Libreta", "Calculadora", "Compás", "Resaltador")
+COLORES = ("azul", "negro", "rojo", "verde", "gris", "blanco", "ITR", "escolar", "premium", "A4")
+
+
+def precio_de(producto_id):
+    # El precio sale del id: así el detalle de pedido no necesita tener todos los productos en memoria
+    return float(100 + (producto_id * 7919) % 49900)
+
+
+def siguiente_id(modelo):
+    return (db.session.query(db.func.max(modelo.id)).scalar() or 0) + 1
+
+
+def insertar(modelo, filas):
+    if filas:
+        db.session.execute(db.insert(modelo), filas)
+
+
+def generar_categorias(cantidad):
+    inicio = siguiente_id(Categoria)
+    insertar(Categoria, [{"id": i, "nombre": f"Categoría {i}"} for i in range(inicio, inicio + cantidad)])
+    db.session.commit()
+    return [c for (c,) in db.session.query(Categoria.id)]
+
+
+def generar_productos(cantidad, categorias, lote):
+    inicio = siguiente_id(Producto)
+    for desde in range(inicio, inicio + cantidad, lote):
+        filas = []
+        for i in range(desde, min(desde + lote, inicio + cantidad)):
+            nombre = f"{random.choice(PALABRAS)} {random.choice(COLORES)} {i}"
+            filas.append({"id": i, "nombre": nombre, "descripcion": f"{nombre}. Producto generado para pruebas.",
+                          "precio": precio_de(i), "stock": random.randint(1000, 100000),
+                          "imagen": "LogoITR-60.png", "categoria_id": random.choice(categorias)})
+        insertar(Producto, filas)
+        db.session.commit()
+    return inicio, inicio + cantidad - 1
+
+
+def generar_usuarios(cantidad, lote):
+    # Un solo hash para todos: generarlo es lento a propósito
+    hash_clave = generate_password_hash(CLAVE)
+    if not Usuario.query.filter_by(email="admin@ejemplo.com").first():
+        db.session.add(Usuario(nombre="Admin", email="admin@ejemplo.com", password_hash=hash_clave, rol="admin"))
+        db.session.commit()
+    inicio = siguiente_id(Usuario)
+    for desde in range(inicio, inicio + cantidad, lote):
+        insertar(Usuario, [{"id": i, "nombre": f"Usuario {i}", "email": f"usuario{i}@ejemplo.com",
+                            "password_hash": hash_clave, "rol": "cliente"}
+                           for i in range(desde, min(desde + lote, inicio + cantidad))])
+        db.session.commit()
+    return inicio, inicio + cantidad - 1
+
+
+def generar_pedidos(cantidad, usuarios, productos, items_por_pedido, lote):
+    inicio = siguiente_id(Pedido)
+    detalle_id = siguiente_id(DetallePedido)
+    ahora = datetime.now()
+    for desde in range(inicio, inicio + cantidad, lote):
+        pedidos, detalles = [], []
+        for i in range(desde, min(desde + lote, inicio + cantidad)):
+            total = 0
+            for producto_id in random.sample(range(productos[0], productos[1] + 1),
+                                             min(random.randint(1, items_por_pedido), productos[1] - productos[0] + 1)):
+                cantidad_item = random.randint(1, 3)
+                total += precio_de(producto_id) * cantidad_item
+                detalles.append({"id": detalle_id, "pedido_id": i, "producto_id": producto_id,
+                                 "cantidad": cantidad_item, "precio_unitario": precio_de(producto_id)})
+                detalle_id += 1
+            pedidos.append({"id": i, "usuario_id": random.randint(*usuarios), "total": total,
+                            "fecha": ahora - timedelta(seconds=random.randint(0, 365 * 24 * 3600)),
+                            "estado": random.choice(ESTADOS)})
+        insertar(Pedido, pedidos)
+        insertar(DetallePedido, detalles)
+        db.session.commit()
+
+
+def medir(nombre, funcion, *args):
+    inicio = time.perf_counter()
+    resultado = funcion(*args)
+    print(f"{nombre}: {time.perf_counter() - inicio:.1f} s")
+    return resultado
+
+
+def generar(categorias=10, productos=1000, usuarios=1000, pedidos=1000, items_por_pedido=4,
+            lote=5000, semilla=1, resumenes=True):
+    """Carga los datos en la base de la aplicación actual (necesita un app_context)."""
+    random.seed(semilla)
+    db.create_all()
+    categorias = medir("categorías", generar_categorias, categorias)
+    productos = medir("productos", generar_productos, productos, categorias, lote)
+    usuarios = medir("usuarios", generar_usuarios, usuarios, lote)
+    medir("pedidos", generar_pedidos, pedidos, usuarios, productos, items_por_pedido, lote)
+    if resumenes:
+        medir("resúmenes", reconstruir_resumen_ventas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--categorias", type=int, default=10)
+    parser.add_argument("--productos", type=int, default=1000)
+    parser.add_argument("--usuarios", type=int, default=1000)
+    parser.add_argument("--pedidos", type=int, default=1000)
+    parser.add_argument("--items-por-pedido", type=int, default=4)
+    parser.add_argument("--lote", type=int, default=5000, help="filas por insert")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--sin-resumenes", action="store_true", help="no recalcular resumen_ventas al final")
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        generar(args.categorias, args.productos, args.usuarios, args.pedidos, args.items_por_pedido,
+                args.lote, args.semilla, resumenes=not args.sin_resumenes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+// ============================
+// FILTROS DEL CATÁLOGO
+// ============================
+// En lugar de recargar toda la página con cada cambio, se pide a /api/catalogo
+// solo la grilla de productos y las cantidades por categoría.
+
+(function () {
+    const form = document.getElementById('filtrosForm');
+    const grilla = document.getElementById('grilla');
+    if (!form || !grilla) {
+        return;
+    }
+
+    const ESPERA_MS = 300;
+    let temporizador = null;
+    let pedidoActual = null;
+
+    function parametros() {
+        const params = new URLSearchParams(new FormData(form));
+        // El slider en su valor máximo es lo mismo que no filtrar por precio
+        if (params.get('precio') === '50000') {
+            params.delete('precio');
+        }
+        if (!params.get('q')) {
+            params.delete('q');
+        }
+        return params;
+    }
+
+    function actualizarCantidades(facetas) {
+        facetas.categorias.forEach(c => {
+            const span = form.querySelector('.cantidad-categoria[data-categoria="' + c.id + '"]');
+            if (span) {
+                span.textContent = c.cantidad;
+            }
+        });
+    }
+
+    function filtrar() {
+        const params = parametros();
+        // Si hay un pedido anterior en curso ya no sirve
+        if (pedidoActual) {
+            pedidoActual.abort();
+        }
+        pedidoActual = new AbortController();
+
+        const api = new URLSearchParams(params);
+        api.set('incluir', 'html');
+        fetch(form.dataset.api + '?' + api, { signal: pedidoActual.signal })
+            .then(r => r.json())
+            .then(datos => {
+                grilla.innerHTML = datos.html;
+                actualizarCantidades(datos.facetas);
+                const query = params.toString();
+                history.replaceState(null, '', query ? '?' + query : location.pathname);
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') {
+                    form.submit();
+                }
+            });
+    }
+
+    // Espera a que el usuario deje de tipear o mover el slider
+    function programarFiltrado() {
+        clearTimeout(temporizador);
+        temporizador = setTimeout(filtrar, ESPERA_MS);
+    }
+
+    form.addEventListener('input', programarFiltrado);
+    form.addEventListener('change', programarFiltrado);
+    form.addEventListener('submit', e => {
+        e.preventDefault();
+        clearTimeout(temporizador);
+        filtrar();
+    });
+
+    // "Ver más" agrega la página siguiente a la grilla sin recargar
+    grilla.addEventListener('click', e => {
+        const enlace = e.target.closest('.paginacion a[data-api]');
+        if (!enlace) {
+            return;
+        }
+        e.preventDefault();
+        fetch(enlace.dataset.api)
+            .then(r => r.text())
+            .then(html => {
+                enlace.closest('.paginacion').remove();
+                grilla.insertAdjacentHTML('beforeend', html);
+            })
+            .catch(() => {
+                location.href = enlace.href;
+            });
+    });
+})();
@@ -0,0 +1,11 @@
+"""Punto de entrada para producción.
+
+Ejemplo: gunicorn -w 4 -b 0.0.0.0:8000 wsgi:app
+(o en Windows: waitress-serve --port=8000 wsgi:app)
+
+La configuración sale de variables de entorno: DATABASE_URL, DATABASE_REPLICA_URL,
+SECRET_KEY, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_PRE_PING, etc.
+"""
+from app import create_app
+
+app = create_app()